@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os, time
+
+from waflib import Logs, Runner
+
+# Seconds between two reads of the system load
+ADAPT_INTERVAL = 1.0
+
+# Memory reserved for every task that is started, in bytes
+JOB_MEMORY = 512 * 1024 * 1024
+
+def read_load_average():
+    try:
+        with open('/proc/loadavg', encoding='utf-8') as loadavg:
+            return float(loadavg.read().split()[0])
+        #endwith
+    except OSError:
+        pass
+    #endtry
+
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+    #endtry
+#enddef
+
+# Return the available memory in bytes, or None if it is unknown
+def read_available_memory():
+    try:
+        with open('/proc/meminfo', encoding='utf-8') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+                #endif
+            #endfor
+        #endwith
+    except OSError:
+        pass
+    #endtry
+
+    return None
+#enddef
+
+# A scheduler that starts fewer tasks when other work is running on the machine
+# or memory runs low. numjobs, set with --max-jobs, is the upper limit.
+class AdaptiveParallel(Runner.Parallel):
+    def __init__(self, bld, j=2):
+        super(AdaptiveParallel, self).__init__(bld, j)
+        self.cpus = os.cpu_count() or 1
+        self.allowed_jobs = j
+        self.last_adapt = 0.0
+    #enddef
+
+    def adapt_jobs(self):
+        now = time.monotonic()
+        if now - self.last_adapt < ADAPT_INTERVAL:
+            return
+        #endif
+
+        self.last_adapt = now
+        allowed = self.numjobs
+
+        # Our own running tasks are part of the load average as well
+        load = read_load_average()
+        if load != None:
+            allowed = int(self.cpus - max(0.0, load - self.count))
+        #endif
+
+        memory = read_available_memory()
+        if memory != None:
+            allowed = min(allowed, self.count + memory // JOB_MEMORY)
+        #endif
+
+        allowed = max(1, min(allowed, self.numjobs))
+        if allowed != self.allowed_jobs:
+            Logs.debug('adaptive_jobs: running at most %d tasks', allowed)
+            self.allowed_jobs = allowed
+        #endif
+    #enddef
+
+    # Wait for running tasks to finish while the limit is reached
+    def refill_task_list(self):
+        self.adapt_jobs()
+
+        while self.count >= self.allowed_jobs:
+            self.get_out()
+            self.adapt_jobs()
+        #endwhile
+
+        super(AdaptiveParallel, self).refill_task_list()
+    #enddef
+#endclass
+
+# Use the adaptive scheduler when --adaptive-jobs is passed
+def enable_adaptive_jobs(bld):
+    if not bld.options.adaptive_jobs:
+        return
+    #endif
+
+    if bld.options.max_jobs != None:
+        if bld.options.max_jobs < 1:
+            bld.fatal('--max-jobs must be at least 1.')
+        #endif
+
+        bld.jobs = bld.options.max_jobs
+    #endif
+
+    Runner.Parallel = AdaptiveParallel
+#enddef
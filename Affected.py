@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib, json, os
+
+from waflib import Context, Errors, Logs, Utils
+
+def get_index_path(bld):
+    return os.path.join(bld.bldnode.abspath(), 'affected_index.json')
+#enddef
+
+def get_state_path(bld):
+    return os.path.join(bld.bldnode.abspath(), 'affected_state.json')
+#enddef
+
+def read_json(file):
+    if not os.path.isfile(file):
+        return None
+    #endif
+
+    with open(file, encoding='utf-8') as json_file:
+        return json.loads(json_file.read())
+    #endwith
+#enddef
+
+def write_json(file, value):
+    with open(file, 'w', encoding='utf-8') as json_file:
+        json_file.write(json.dumps(value, sort_keys=True))
+    #endwith
+#enddef
+
+def hash_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return hashlib.md5(file.read()).hexdigest()
+        #endwith
+    except OSError:
+        return None
+    #endtry
+#enddef
+
+# The source files of a task generator, glob patterns are already expanded
+def get_source_files(tgen):
+    try:
+        nodes = tgen.to_nodes(getattr(tgen, 'source', []))
+    except Errors.WafError:
+        return set()
+    #endtry
+
+    return set(node.abspath() for node in nodes)
+#enddef
+
+# Record the files each project compiles: its project file, its sources and the
+# headers the waf scanner found for them during this build
+def save_affected_index(bld):
+    index = read_json(get_index_path(bld)) or dict()
+
+    for tgen in bld.get_all_task_gen():
+        if not getattr(tgen, 'posted', False):
+            continue
+        #endif
+
+        files = set()
+        if getattr(tgen, 'project_file', None):
+            files.add(os.path.abspath(tgen.project_file))
+        #endif
+
+        files.update(get_source_files(tgen))
+
+        for tsk in getattr(tgen, 'compiled_tasks', []):
+            files.update(node.abspath() for node in tsk.inputs)
+            files.update(node.abspath() for node in bld.node_deps.get(tsk.uid(), []))
+        #endfor
+
+        index[tgen.name] = sorted(files)
+    #endfor
+
+    write_json(get_index_path(bld), index)
+#enddef
+
+# Changed files according to git, relative to --affected-base. Both commands
+# print paths relative to the top directory, which may be below the repository root.
+def get_git_changes(bld):
+    top = bld.srcnode.abspath()
+
+    out = bld.cmd_and_log(
+        ['git', 'diff', '--name-only', '--relative', bld.options.affected_base, '--'],
+        cwd=top,
+        quiet=Context.BOTH)
+    out += bld.cmd_and_log(
+        ['git', 'ls-files', '--others', '--exclude-standard'],
+        cwd=top,
+        quiet=Context.BOTH)
+
+    return set(os.path.normcase(os.path.normpath(os.path.join(top, line))) \
+        for line in out.splitlines() if line.strip())
+#enddef
+
+# Changed files according to their contents when the tests last ran
+def get_signature_changes(bld, index, sources):
+    state = read_json(get_state_path(bld)) or dict()
+    files = set(path for paths in index.values() for path in paths) | sources
+
+    changed = set()
+    current = dict()
+    for path in files:
+        current[path] = hash_file(path)
+        if state.get(path) != current[path]:
+            changed.add(os.path.normcase(path))
+        #endif
+    #endfor
+
+    def save_state(bld):
+        write_json(get_state_path(bld), current)
+    #enddef
+
+    bld.add_post_fun(save_state)
+    return changed
+#enddef
+
+# Limit the build to the test projects that compile a changed file, directly
+# or through the projects they use
+def select_affected_tests(bld):
+    index = read_json(get_index_path(bld))
+    if index == None:
+        Logs.pprint('YELLOW', 'No affected test index yet, running all tests')
+        return
+    #endif
+
+    tgens = dict()
+    sources = dict()
+    for tgen in bld.get_all_task_gen():
+        tgens[tgen.name] = tgen
+        sources[tgen.name] = get_source_files(tgen)
+    #endfor
+
+    if bld.options.affected_base:
+        changed = get_git_changes(bld)
+    else:
+        changed = get_signature_changes(bld, index, set().union(*sources.values()))
+    #endif
+
+    affected = set()
+    for name in tgens:
+        if not name in index:
+            # Never built before, so nothing is known about its inputs
+            affected.add(name)
+        elif any(os.path.normcase(path) in changed for path in index[name]):
+            affected.add(name)
+        elif not sources[name] <= set(index[name]):
+            # Sources were added without changing the project file, through
+            # a glob pattern that matches a new file
+            affected.add(name)
+        #endif
+    #endfor
+
+    # Follow the use graph in reverse, to the projects depending on a change
+    users = dict()
+    for name, tgen in tgens.items():
+        for used in Utils.to_list(getattr(tgen, 'use', [])):
+            users.setdefault(used, set()).add(name)
+        #endfor
+    #endfor
+
+    todo = list(affected)
+    while todo:
+        for user in users.get(todo.pop(), []):
+            if not user in affected:
+                affected.add(user)
+                todo.append(user)
+            #endif
+        #endfor
+    #endwhile
+
+    tests = sorted(name for name in affected \
+        if 'test' in Utils.to_list(getattr(tgens[name], 'features', [])))
+
+    Logs.pprint(
+        'CYAN',
+        'Affected: %d changed files, %d projects, %d of %d tests'
+        % (len(changed),
+            len(affected),
+            len(tests),
+            len([tgen for tgen in tgens.values() \
+                if 'test' in Utils.to_list(getattr(tgen, 'features', []))])))
+
+    if tests:
+        bld.targets = ','.join(tests)
+    elif affected:
+        bld.targets = ','.join(sorted(affected))
+        bld.options.no_tests = True
+    else:
+        # Without targets waf builds every project, skip the build instead
+        bld.options.no_tests = True
+        bld.compile = lambda: None
+    #endif
+#enddef
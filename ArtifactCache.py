@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib, json, os, shutil, tempfile, threading, time
+import urllib.error, urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from waflib import Context, Logs, Task, Utils
+
+# Task classes of which the outputs are stored in the artifact cache
+CACHED_TASK_CLASSES = [
+    'c',
+    'cxx',
+    'cprogram',
+    'cxxprogram',
+    'cshlib',
+    'cxxshlib',
+    'cstlib',
+    'cxxstlib'
+]
+
+# Size of the chunks used to copy outputs from and to the cache
+CHUNK_SIZE = 1024 * 1024
+
+# Minimum amount of seconds between two trims of a directory store by builds
+TRIM_INTERVAL = 60 * 60
+
+# Replace the top directory in a value, so it is the same in every checkout
+def make_relocatable(value, top):
+    return value.replace(top, '.').replace(os.path.normcase(top), '.')
+#enddef
+
+# Replace the top directory in each element of a flag list. The repr of a list
+# escapes backslashes, in which a windows top directory would never be found.
+def make_relocatable_flags(value, top):
+    if isinstance(value, str):
+        return make_relocatable(value, top)
+    #endif
+
+    return repr([make_relocatable(str(flag), top) for flag in Utils.to_list(value)])
+#enddef
+
+# Fingerprint the compiler binaries and the flags of the toolset, this is
+# combined with the task signature to make the artifact cache key. A relocatable
+# fingerprint is the same for every checkout, reproducible builds always use one.
+def get_toolset_fingerprint(cfg, relocatable=False):
+    hasher = hashlib.md5()
+
+    for compiler, name in [(cfg.env.CC, cfg.env.CC_NAME), (cfg.env.CXX, cfg.env.CXX_NAME)]:
+        version = str()
+
+        if name == 'msvc':
+            version = str(cfg.env.MSVC_VERSION)
+        else:
+            try:
+                version = cfg.cmd_and_log(
+                    Utils.to_list(compiler) + ['--version'],
+                    quiet=Context.BOTH)
+            except Exception:
+                version = str(compiler)
+            #endtry
+        #endif
+
+        hasher.update(version.encode('utf-8'))
+    #endfor
+
+    for var in ['CFLAGS', 'CXXFLAGS', 'DEFINES', 'SYSINCLUDES']:
+        value = repr(cfg.env[var])
+        if relocatable or cfg.env.REPRODUCIBLE:
+            value = make_relocatable_flags(cfg.env[var], cfg.path.abspath())
+        #endif
+
+        hasher.update(value.encode('utf-8'))
+    #endfor
+
+    return hasher.hexdigest()
+#enddef
+
+# An entry is a json header line with the size and mode of every output,
+# followed by the contents of the outputs
+def write_entry(stream, paths):
+    header = []
+    for path in paths:
+        st = os.stat(path)
+        header.append([st.st_size, st.st_mode & 0o777])
+    #endfor
+
+    stream.write((json.dumps(header) + '\n').encode('utf-8'))
+
+    for path in paths:
+        with open(path, 'rb') as file:
+            shutil.copyfileobj(file, stream, CHUNK_SIZE)
+        #endwith
+    #endfor
+#enddef
+
+def read_entry(stream, paths):
+    header = json.loads(stream.readline().decode('utf-8'))
+
+    if len(header) != len(paths):
+        raise ValueError('Cache entry has %d outputs, expected %d' % (len(header), len(paths)))
+    #endif
+
+    for path, (size, mode) in zip(paths, header):
+        with open(path, 'wb') as file:
+            while size > 0:
+                chunk = stream.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError('Cache entry is truncated')
+                #endif
+
+                file.write(chunk)
+                size -= len(chunk)
+            #endwhile
+        #endwith
+
+        os.chmod(path, mode)
+    #endfor
+#enddef
+
+# Stores cache entries in a local or network (NFS) directory
+class DirectoryStore(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+    #enddef
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+    #enddef
+
+    def open(self, key):
+        path = self.get_entry_path(key)
+
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        #endtry
+
+        # Mark the entry as recently used for trim
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        #endtry
+
+        return file
+    #enddef
+
+    def get(self, key, paths):
+        file = self.open(key)
+        if file is None:
+            return False
+        #endif
+
+        with file:
+            read_entry(file, paths)
+        #endwith
+
+        return True
+    #enddef
+
+    # Write to a temporary file first, so other processes never see a partial entry
+    def put_stream(self, key, stream):
+        path = self.get_entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                shutil.copyfileobj(stream, file, CHUNK_SIZE)
+            #endwith
+
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        #endtry
+    #enddef
+
+    def put(self, key, paths):
+        path = self.get_entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write_entry(file, paths)
+            #endwith
+
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        #endtry
+    #enddef
+
+    # Remove the least recently used entries until the cache fits in max_size
+    def trim(self, max_size):
+        entries = []
+        total = 0
+
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                # Temporary files and the trim stamp are not entries
+                if name.startswith('.'):
+                    continue
+                #endif
+
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                #endtry
+
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            #endfor
+        #endfor
+
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= max_size:
+                break
+            #endif
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            #endtry
+
+            total -= size
+            removed += 1
+        #endfor
+
+        return removed
+    #enddef
+
+    # Trim at most once per TRIM_INTERVAL over all builds that share the store,
+    # scanning the whole store after every build is slow on a network directory
+    def trim_periodically(self, max_size):
+        stamp = os.path.join(self.path, '.last_trim')
+
+        try:
+            if time.time() - os.path.getmtime(stamp) < TRIM_INTERVAL:
+                return 0
+            #endif
+        except OSError:
+            pass
+        #endtry
+
+        # Claim the trim before scanning, so builds finishing meanwhile skip it
+        with open(stamp, 'w'):
+            pass
+        #endwith
+
+        return self.trim(max_size)
+    #enddef
+#endclass
+
+# Stores cache entries on a HTTP server that supports GET and PUT, such as the
+# artifact_cache_server command
+class HttpStore(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+    #enddef
+
+    def get(self, key, paths):
+        try:
+            with urllib.request.urlopen(self.url + '/' + key) as response:
+                read_entry(response, paths)
+            #endwith
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            #endif
+
+            raise
+        #endtry
+
+        return True
+    #enddef
+
+    def put(self, key, paths):
+        with tempfile.TemporaryFile() as file:
+            write_entry(file, paths)
+            size = file.tell()
+            file.seek(0)
+
+            request = urllib.request.Request(
+                self.url + '/' + key,
+                data=file,
+                method='PUT',
+                headers={'Content-Length': str(size)})
+            urllib.request.urlopen(request).close()
+        #endwith
+    #enddef
+
+    # The server is responsible for its own size limit
+    def trim(self, max_size):
+        return 0
+    #enddef
+
+    def trim_periodically(self, max_size):
+        return 0
+    #enddef
+#endclass
+
+class ArtifactCache(object):
+    def __init__(self, store, fingerprint):
+        self.store = store
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+    #enddef
+
+    def get_key(self, tsk):
+        if tsk.env.REPRODUCIBLE:
+            return self.get_relocatable_key(tsk)
+        #endif
+
+        hasher = hashlib.md5()
+        hasher.update(self.fingerprint.encode('utf-8'))
+        hasher.update(tsk.uid())
+        hasher.update(tsk.signature())
+        return hasher.hexdigest()
+    #enddef
+
+    # The task uid and signature contain absolute paths. Reproducible builds use
+    # paths relative to the top directory instead, so checkouts share entries.
+    def get_relocatable_key(self, tsk):
+        bld = tsk.generator.bld
+        top = bld.srcnode
+
+        hasher = hashlib.md5()
+        hasher.update(self.fingerprint.encode('utf-8'))
+        hasher.update(tsk.__class__.__name__.encode('utf-8'))
+
+        for node in tsk.outputs:
+            hasher.update(self.get_node_path(bld, node).encode('utf-8'))
+        #endfor
+
+        dependencies = tsk.inputs + tsk.dep_nodes + bld.node_deps.get(tsk.uid(), [])
+        for node in dependencies:
+            hasher.update(self.get_node_path(bld, node).encode('utf-8'))
+            hasher.update(node.get_bld_sig())
+        #endfor
+
+        for var in tsk.vars:
+            value = make_relocatable_flags(tsk.env[var], top.abspath())
+            hasher.update(value.encode('utf-8'))
+        #endfor
+
+        return hasher.hexdigest()
+    #enddef
+
+    # Nodes in the build directory or the checkout are relative to these, other
+    # nodes, such as system headers, are at the same place for every checkout
+    def get_node_path(self, bld, node):
+        if node.is_child_of(bld.bldnode):
+            return '<build>/' + node.path_from(bld.bldnode).replace('\\', '/')
+        #endif
+
+        if node.is_child_of(bld.srcnode):
+            return node.path_from(bld.srcnode).replace('\\', '/')
+        #endif
+
+        return node.abspath()
+    #enddef
+
+    def count(self, attribute):
+        with self.lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+        #endwith
+    #enddef
+
+    def retrieve(self, tsk):
+        paths = [node.abspath() for node in tsk.outputs]
+
+        try:
+            hit = self.store.get(self.get_key(tsk), paths)
+        except Exception as e:
+            Logs.debug('artifact_cache: failed to retrieve %r: %r', tsk, e)
+            self.count('errors')
+            hit = False
+        #endtry
+
+        self.count('hits' if hit else 'misses')
+        return hit
+    #enddef
+
+    def put(self, tsk):
+        paths = [node.abspath() for node in tsk.outputs]
+
+        try:
+            self.store.put(self.get_key(tsk), paths)
+        except Exception as e:
+            Logs.debug('artifact_cache: failed to store %r: %r', tsk, e)
+            self.count('errors')
+        else:
+            self.count('stores')
+        #endtry
+    #enddef
+#endclass
+
+# Wrap run and post_run of a task class to retrieve and store its outputs
+def make_cached(cls):
+    if getattr(cls, 'has_artifact_cache', False):
+        return
+    #endif
+
+    run = cls.run
+    post_run = cls.post_run
+
+    def cached_run(self):
+        cache = getattr(self.generator.bld, 'artifact_cache', None)
+        if cache and self.outputs and cache.retrieve(self):
+            self.artifact_cache_hit = True
+            return 0
+        #endif
+
+        return run(self)
+    #enddef
+
+    def cached_post_run(self):
+        ret = post_run(self)
+
+        cache = getattr(self.generator.bld, 'artifact_cache', None)
+        if cache and self.outputs and not getattr(self, 'artifact_cache_hit', False):
+            cache.put(self)
+        #endif
+
+        return ret
+    #enddef
+
+    cls.run = cached_run
+    cls.post_run = cached_post_run
+    cls.has_artifact_cache = True
+#enddef
+
+def get_store(location):
+    if location.startswith('http://') or location.startswith('https://'):
+        return HttpStore(location)
+    #endif
+
+    return DirectoryStore(location)
+#enddef
+
+# Print the hit rate, trim the cache and save the statistics in the build directory
+def report_artifact_cache(bld):
+    cache = bld.artifact_cache
+
+    lookups = cache.hits + cache.misses
+    hit_rate = 0.0
+    if lookups:
+        hit_rate = 100.0 * cache.hits / lookups
+    #endif
+
+    removed = cache.store.trim_periodically(bld.options.artifact_cache_size * 1024 * 1024)
+
+    Logs.pprint(
+        'CYAN',
+        'Artifact cache: %d hits, %d misses (%.1f%% hit rate), %d stored, %d errors, %d evicted'
+        % (cache.hits, cache.misses, hit_rate, cache.stores, cache.errors, removed))
+
+    stats = {
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'hit_rate': hit_rate,
+        'stores': cache.stores,
+        'errors': cache.errors,
+        'evicted': removed
+    }
+
+    file = os.path.join(bld.bldnode.abspath(), 'artifact_cache_stats.json')
+    with open(file, 'w', encoding='utf-8') as stats_file:
+        stats_file.write(json.dumps(stats, indent=4, sort_keys=True))
+    #endwith
+#enddef
+
+# Enable the artifact cache if a location was passed with --artifact-cache
+def enable_artifact_cache(bld):
+    if not bld.options.artifact_cache:
+        return
+    #endif
+
+    if not bld.env.TOOLSET_FINGERPRINT:
+        bld.fatal('The artifact cache requires a toolset fingerprint, please reconfigure.')
+    #endif
+
+    bld.artifact_cache = ArtifactCache(
+        get_store(bld.options.artifact_cache),
+        bld.env.TOOLSET_FINGERPRINT)
+
+    for task_class in CACHED_TASK_CLASSES:
+        if task_class in Task.classes:
+            make_cached(Task.classes[task_class])
+        #endif
+    #endfor
+
+    bld.add_post_fun(report_artifact_cache)
+#enddef
+
+class ArtifactCacheHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        file = self.server.store.open(os.path.basename(self.path))
+        if file is None:
+            self.send_error(404)
+            return
+        #endif
+
+        with file:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(file.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile, CHUNK_SIZE)
+        #endwith
+    #enddef
+
+    def do_PUT(self):
+        size = int(self.headers['Content-Length'])
+
+        with tempfile.TemporaryFile() as file:
+            while size > 0:
+                chunk = self.rfile.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    self.send_error(400)
+                    return
+                #endif
+
+                file.write(chunk)
+                size -= len(chunk)
+            #endwhile
+
+            file.seek(0)
+            self.server.store.put_stream(os.path.basename(self.path), file)
+        #endwith
+
+        self.send_response(201)
+        self.end_headers()
+
+        with self.server.lock:
+            self.server.puts += 1
+            if self.server.puts % 100 == 0:
+                self.server.store.trim(self.server.max_size)
+            #endif
+        #endwith
+    #enddef
+
+    def log_message(self, format, *args):
+        Logs.debug('artifact_cache: ' + format, *args)
+    #enddef
+#endclass
+
+class ArtifactCacheServerContext(Context.Context):
+    '''Serve the directory passed with --artifact-cache over HTTP'''
+    cmd = 'artifact_cache_server'
+
+    def execute(self):
+        if not self.options.artifact_cache:
+            self.fatal('Pass the directory to serve with --artifact-cache.')
+        #endif
+
+        server = ThreadingHTTPServer(
+            ('', self.options.artifact_cache_port),
+            ArtifactCacheHandler)
+        server.store = DirectoryStore(self.options.artifact_cache)
+        server.max_size = self.options.artifact_cache_size * 1024 * 1024
+        server.lock = threading.Lock()
+        server.puts = 0
+
+        Logs.pprint(
+            'CYAN',
+            'Serving artifact cache %s on port %d'
+            % (server.store.path, self.options.artifact_cache_port))
+        server.serve_forever()
+    #enddef
+#endclass
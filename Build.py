@@ -1,19 +1,55 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-import sysconfig
+import collections, hashlib, shlex, sysconfig, time
 
-from waflib import Logs, Options
+from waflib import Errors, Logs, Options, Task, Utils
 from waflib.Build import BuildContext
 from waflib.Configure import conf
 from waflib.TaskGen import feature, before_method, after_method, taskgen_method
 from waflib.Tools import waf_unit_test
 from waflib.Tools.ccroot import USELIB_VARS
 
+from AdaptiveJobs import enable_adaptive_jobs
+from Affected import save_affected_index, select_affected_tests
+from ArtifactCache import enable_artifact_cache
 from Common import *
+from GarbageCollection import enable_auto_gc
+from SourceIndex import expand_source_globs
+from TimeTrace import enable_time_trace
 
 run_tests = False
 
+# A flag list that is shared between task generators and tasks.
+# Waf only reads these lists, so any modification is a bug and raises.
+class FlagList(list):
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Interned flag lists are shared and cannot be modified')
+    #enddef
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+    def __reduce__(self):
+        return (FlagList, (list(self),))
+    #enddef
+#endclass
+
+interned_flags = dict()
+
+# Return the shared, immutable copy of a list of flags
+def intern_flags(flags):
+    key = tuple(map(sys.intern, flags))
+
+    interned = interned_flags.get(key)
+    if interned is None:
+        interned = FlagList(key)
+        interned_flags[key] = interned
+    #endif
+
+    return interned
+#enddef
+
 def summary(bld):
     lst = getattr(bld, 'utest_results', [])
     if lst:
@@ -25,15 +61,227 @@ def summary(bld):
 
         Logs.pprint('CYAN', '  Tests that succeed: %d/%d' % (total - tfail, total))
         Logs.pprint('CYAN', '  Tests that fail: %d/%d' % (tfail, total))
+        logs = getattr(bld, 'utest_logs', {})
         for (f, code, out, err) in lst:
             if code:
                 Logs.pprint('CYAN', '    %s' % f)
                 Logs.pprint('RED', 'Status: %r' % code)
+
+                if out:
+                    Logs.pprint('NORMAL', out.decode('utf-8', 'replace'))
+                #endif
+
+                if f in logs:
+                    Logs.pprint('CYAN', '    Full output: %s' % logs[f])
+                #endif
             #endif
         #endfor
+
+        if getattr(bld, 'utest_stopped', False):
+            Logs.pprint('YELLOW', '  Remaining tests were not run because of --fail-fast')
+        #endif
     #endif
 #enddef
 
+# Amount of recent results per test that are kept in the test history
+TEST_HISTORY_LENGTH = 10
+
+# Amount of recent results checked for failures when ordering the tests
+TEST_RECENT_FAILURES = 3
+
+def get_test_history_path(bld):
+    return os.path.join(bld.bldnode.abspath(), 'test_history.json')
+#enddef
+
+# Load the recent outcomes and durations of every test
+def load_test_history(bld):
+    file = get_test_history_path(bld)
+    if not os.path.isfile(file):
+        return dict()
+    #endif
+
+    with open(file, encoding='utf-8') as history_file:
+        return json.loads(history_file.read())
+    #endwith
+#enddef
+
+# Add the results of the tests that ran to the test history
+def save_test_history(bld):
+    entries = getattr(bld, 'utest_entries', {})
+    if not entries:
+        return
+    #endif
+
+    history = bld.utest_history
+    for name in entries:
+        history.setdefault(name, [])
+        history[name].append(entries[name])
+        history[name] = history[name][-TEST_HISTORY_LENGTH:]
+    #endfor
+
+    with open(get_test_history_path(bld), 'w', encoding='utf-8') as history_file:
+        history_file.write(json.dumps(history, indent=4, sort_keys=True))
+    #endwith
+#enddef
+
+# Raise the priority of tests that failed recently or take long to run, so
+# failures are reported early and long tests don't finish last.
+@feature('test')
+@after_method('make_test')
+def order_test(self):
+    history = getattr(self.bld, 'utest_history', {}).get(self.name)
+    if not history:
+        return
+    #endif
+
+    duration = sum(entry['duration'] for entry in history) / len(history)
+    weight = int(duration * 1000)
+
+    if any(entry['failed'] for entry in history[-TEST_RECENT_FAILURES:]):
+        weight += 10 ** 9
+    #endif
+
+    for tsk in self.tasks:
+        if tsk is getattr(self, 'link_task', None) \
+                or tsk.__class__.__name__ == 'utest':
+            tsk.weight = weight
+        #endif
+    #endfor
+#enddef
+
+# Amount of bytes of test output kept in memory, the full output is in the log
+TEST_OUTPUT_TAIL = 64 * 1024
+
+# Override waf_unit_test's test execution so the output of a test is streamed to
+# a log file in the build directory instead of being kept in memory in full.
+@taskgen_method
+def ut_run(self, tsk):
+    test_exec = getattr(self, 'ut_exec', [tsk.inputs[0].abspath()])
+    test_file = tsk.inputs[0].abspath()
+
+    # Wrap the test in --testcmd, e.g. "valgrind %s", like waf_unit_test does
+    ut_cmd = getattr(self, 'ut_cmd', False) or getattr(Options.options, 'testcmd', False)
+    if ut_cmd:
+        test_exec = shlex.split(ut_cmd % Utils.shell_escape(test_exec))
+    #endif
+
+    tsk.ut_exec = test_exec
+
+    log_node = self.bld.bldnode.make_node(['test_logs', self.name + '.log'])
+    log_node.parent.mkdir()
+
+    tail = collections.deque()
+    tail_size = 0
+    start = time.perf_counter()
+
+    with open(log_node.abspath(), 'wb') as log_file:
+        process = Utils.subprocess.Popen(
+            test_exec,
+            cwd=tsk.get_cwd().abspath(),
+            env=tsk.get_test_env(),
+            stdout=Utils.subprocess.PIPE,
+            stderr=Utils.subprocess.STDOUT,
+            shell=isinstance(test_exec, str))
+
+        for chunk in iter(lambda: process.stdout.read1(65536), b''):
+            log_file.write(chunk)
+
+            tail.append(chunk)
+            tail_size += len(chunk)
+            while tail_size - len(tail[0]) >= TEST_OUTPUT_TAIL:
+                tail_size -= len(tail.popleft())
+            #endwhile
+        #endfor
+
+        process.stdout.close()
+        process.wait()
+    #endwith
+
+    duration = time.perf_counter() - start
+    out = b''.join(tail)[-TEST_OUTPUT_TAIL:]
+    tsk.waf_unit_test_results = result = (test_file, process.returncode, out, b'')
+
+    waf_unit_test.testlock.acquire()
+    try:
+        try:
+            self.bld.utest_logs[test_file] = log_node.abspath()
+        except AttributeError:
+            self.bld.utest_logs = {test_file: log_node.abspath()}
+        #endtry
+
+        entry = {'failed': process.returncode != 0, 'duration': duration}
+        try:
+            self.bld.utest_entries[self.name] = entry
+        except AttributeError:
+            self.bld.utest_entries = {self.name: entry}
+        #endtry
+
+        return self.add_test_results(result)
+    finally:
+        waf_unit_test.testlock.release()
+    #endtry
+#enddef
+
+# With --fail-fast a failing test fails its task, waf then stops scheduling
+# tasks and waits for the ones that are still running before it stops the build.
+@taskgen_method
+def add_test_results(self, tup):
+    waf_unit_test.add_test_results(self, tup)
+
+    if tup[1] and self.bld.options.fail_fast:
+        self.bld.utest_stopped = True
+        return tup[1]
+    #endif
+#enddef
+
+# A build stopped by --fail-fast raises before the post funs run, so the
+# test results are reported and saved once the running tasks finished.
+def report_failed_build(bld):
+    compile = bld.compile
+
+    def compile_and_report():
+        try:
+            compile()
+        except Errors.BuildError:
+            if getattr(bld, 'utest_stopped', False):
+                summary(bld)
+                save_test_history(bld)
+            #endif
+
+            raise
+        #endtry
+    #enddef
+
+    bld.compile = compile_and_report
+#enddef
+
+# Task classes that link shared libraries and executables
+LINK_TASK_CLASSES = ['cprogram', 'cxxprogram', 'cshlib', 'cxxshlib']
+
+# Limit the amount of links running at the same time, these can use a lot of
+# memory. The command line takes precedence over the toolset file.
+def limit_link_jobs(bld):
+    link_jobs = bld.options.link_jobs
+    if link_jobs == None:
+        link_jobs = get_toolset(bld).get('link_jobs', 0)
+    #endif
+
+    if link_jobs < 0:
+        bld.fatal('The amount of link jobs cannot be negative.')
+    #endif
+
+    semaphore = None
+    if link_jobs > 0:
+        semaphore = Task.TaskSemaphore(link_jobs)
+    #endif
+
+    for task_class in LINK_TASK_CLASSES:
+        if task_class in Task.classes:
+            Task.classes[task_class].semaphore = semaphore
+        #endif
+    #endfor
+#enddef
+
 def build(bld):
     if sysconfig.get_platform() == 'mingw':
         Logs.enable_colors(2)
@@ -48,8 +296,33 @@ def build(bld):
         bld.options.no_tests = True
     #endif
 
+    limit_link_jobs(bld)
+    enable_adaptive_jobs(bld)
+    enable_artifact_cache(bld)
+    enable_time_trace(bld)
+
+    if run_tests:
+        bld.utest_history = load_test_history(bld)
+
+        if bld.options.affected:
+            bld.add_pre_fun(select_affected_tests)
+        #endif
+    #endif
+
     bld.options.clear_failed_tests = True
     bld.add_post_fun(summary)
+    enable_auto_gc(bld)
+
+    if run_tests:
+        # Only test runs select affected tests, so only these update the index
+        bld.add_post_fun(save_affected_index)
+        bld.add_post_fun(save_test_history)
+
+        if bld.options.fail_fast:
+            report_failed_build(bld)
+        #endif
+    #endif
+
     bld.add_post_fun(waf_unit_test.set_exit_code)
 #enddef
 
@@ -106,6 +379,8 @@ def project(self, project_file):
         #endif
     #enddef
 
+    # Defines per project type, such as "objlib" and "objlib_<configuration>",
+    # are read from the defines of the project file
     defines = []
     if 'defines' in project:
         read_option(defines, 'base', project['defines'])
@@ -182,9 +457,37 @@ def project(self, project_file):
         export_includes = project['export_includes']
     #endif
 
+    # Projects with C++20 modules are scanned for imports and exports, their
+    # module interfaces are available to projects that use them
+    if project.get('modules', False) == True:
+        features.append('cxxmodules')
+    #endif
+
+    # How the sources are divided over the unity batches, see stable_unity
+    unity_partitioning = project.get('unity_partitioning', 'sequential')
+    if self.options.unity_partitioning != None:
+        unity_partitioning = self.options.unity_partitioning
+    #endif
+
+    if not unity_partitioning in ['sequential', 'stable']:
+        self.fatal(project['name'] + ': Invalid unity_partitioning "' \
+            + unity_partitioning + '", valid values are [sequential, stable].')
+    #endif
+
+    # The amount of stable unity batches, see get_unity_buckets when not set
+    unity_buckets = project.get('unity_buckets', None)
+    if unity_buckets != None and (not isinstance(unity_buckets, int) or unity_buckets < 1):
+        self.fatal(project['name'] + ': unity_buckets must be a positive number.')
+    #endif
+
     # If a project is in unity build mode, we pass the unity feature.
     # This will call all functions with @feature('unity')
-    features.append('nounity')
+    # Sequential partitioning keeps nounity as well, which disables the
+    # batching, so existing unity projects build the way they always have.
+    if project['unity_build'] != True or unity_partitioning != 'stable':
+        features.append('nounity')
+    #endif
+
     if project['unity_build'] == True:
         features.append('unity')
     #endif
@@ -214,6 +517,23 @@ def project(self, project_file):
         sources += project[toolset_sources]
     #endif
 
+    # Sources may contain glob patterns, these are relative to the project file
+    sources = expand_source_globs(self, self.path.abspath(), sources)
+
+    # Identical flag lists are shared between all projects, waf only reads them.
+    # uselib is excluded on purpose, waf appends to it while processing use.
+    defines = intern_flags(defines)
+    includes = intern_flags(includes)
+    lib = intern_flags(lib)
+    lib_path = intern_flags(lib_path)
+    stlib = intern_flags(stlib)
+    stlib_path = intern_flags(stlib_path)
+    rpath = intern_flags(rpath)
+    export_includes = intern_flags(export_includes)
+    export_force_includes = intern_flags(export_force_includes)
+    exe_use = intern_flags(use + ['EXE'])
+    use = intern_flags(use)
+
     task_gen = None
     if project['type'] == 'shlib':
         self.shlib(
@@ -231,11 +551,14 @@ def project(self, project_file):
             use=use,
             uselib=use + uselib,
             features=features,
+            unity_partitioning=unity_partitioning,
+            unity_buckets=unity_buckets,
+            project_file=file,
             export_system_includes=export_includes,
             export_force_includes=export_force_includes,
             # Add an extra define that can be checked to see if a project is
             # built as a DLL or not. Needed for dllimport on windows.
-            export_defines=[project['name'].upper() + '_AS_DLL'])
+            export_defines=intern_flags([project['name'].upper() + '_AS_DLL']))
     elif project['type'] == 'stlib':
         self.stlib(
             name=project['name'],
@@ -252,12 +575,35 @@ def project(self, project_file):
             use=use,
             uselib=use + uselib,
             features=features,
+            unity_partitioning=unity_partitioning,
+            unity_buckets=unity_buckets,
+            project_file=file,
             export_system_includes=export_includes,
             export_force_includes=export_force_includes,
             # Add an extra define that can be checked to see if a project is
             # built as a static library or not. This has been added because of
             # the one above, if this is for whatever reason ever needed.
-            export_defines=[project['name'].upper() + '_AS_LIB'])
+            export_defines=intern_flags([project['name'].upper() + '_AS_LIB']))
+    elif project['type'] == 'objlib':
+        # The objects are linked directly into the projects that use this one,
+        # so there is no archive to create. Link flags are left to the users.
+        self.objects(
+            name=project['name'],
+            source=sources,
+            target=target,
+            defines=defines,
+            includes=includes,
+            use=use,
+            uselib=use + uselib,
+            features=features,
+            unity_partitioning=unity_partitioning,
+            unity_buckets=unity_buckets,
+            project_file=file,
+            export_system_includes=export_includes,
+            export_force_includes=export_force_includes,
+            # Consumers see the same define as for a static library, the
+            # objects end up in the user the same way an archive would.
+            export_defines=intern_flags([project['name'].upper() + '_AS_LIB']))
     elif project['type'] == 'exe':
         self.program(
             name=project['name'],
@@ -271,9 +617,12 @@ def project(self, project_file):
             stlib=stlib,
             stlibpath=stlib_path,
             rpath=rpath,
-            use=use + ['EXE'],
+            use=exe_use,
             uselib=use + uselib,
             features=features,
+            unity_partitioning=unity_partitioning,
+            unity_buckets=unity_buckets,
+            project_file=file,
             export_system_includes=export_includes)
     elif project['type'] == 'test':
         self.program(
@@ -288,13 +637,28 @@ def project(self, project_file):
             stlib=stlib,
             stlibpath=stlib_path,
             rpath=rpath,
-            use=use + ['EXE'],
+            use=exe_use,
             uselib=use + uselib,
             features=features + ['test'],
+            unity_partitioning=unity_partitioning,
+            unity_buckets=unity_buckets,
+            project_file=file,
             export_system_includes=export_includes)
     #endif
 #enddef
 
+# Share the include paths and defines waf resolved for a task generator.
+# Tasks derive their environment from the task generator, so they share them too.
+@feature('c', 'cxx')
+@after_method('propagate_uselib_vars', 'apply_incpaths')
+def intern_env_flags(self):
+    for var in ['DEFINES', 'INCPATHS']:
+        if var in self.env.table:
+            self.env.table[var] = intern_flags(self.env.table[var])
+        #endif
+    #endfor
+#enddef
+
 @feature('nounity')
 def no_unity(self):
     pass
@@ -315,3 +679,126 @@ def batch_size(self):
         return getattr(Options.options, 'batchsize', unity.MAX_BATCH)
     #endif
 #enddef
+
+# Outputs of compile tasks that are not object files: debug info of MSVC and
+# split DWARF, and module interfaces
+UNLINKED_EXTENSIONS = ['.pdb', '.dwo', '.pcm', '.gcm']
+
+# Override ccroot's accept_node_to_link function. Projects link every output of
+# the compile tasks of an objlib they use, except the ones filtered here.
+@taskgen_method
+def accept_node_to_link(self, node):
+    return not os.path.splitext(node.name)[1] in UNLINKED_EXTENSIONS
+#enddef
+
+# Jump consistent hash, maps a 64 bit key to one of a fixed amount of buckets.
+# When the amount of buckets changes only the minimal amount of keys move.
+def jump_hash(key, buckets):
+    bucket = -1
+    j = 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    #endwhile
+
+    return bucket
+#enddef
+
+# The amount of stable unity batches of projects without "unity_buckets". It is
+# derived from the amount of sources the first time a project is built and then
+# kept, a changing amount would move sources out of every batch.
+def get_unity_buckets(bld):
+    buckets = getattr(bld, 'unity_buckets', None)
+    if buckets != None:
+        return buckets
+    #endif
+
+    buckets = bld.unity_buckets = dict()
+
+    file = os.path.join(bld.bldnode.abspath(), 'unity_buckets.json')
+    if os.path.isfile(file):
+        with open(file, encoding='utf-8') as buckets_file:
+            buckets.update(json.loads(buckets_file.read()))
+        #endwith
+    #endif
+
+    def save_unity_buckets(bld):
+        with open(file, 'w', encoding='utf-8') as buckets_file:
+            buckets_file.write(json.dumps(bld.unity_buckets, indent=4, sort_keys=True))
+        #endwith
+    #enddef
+
+    bld.add_post_fun(save_unity_buckets)
+    return buckets
+#enddef
+
+def bind_stable_unity(tgen, cls_name, exts, buckets):
+    from waflib.TaskGen import task_gen
+
+    if not 'mappings' in tgen.__dict__:
+        tgen.mappings = dict(tgen.mappings)
+    #endif
+
+    for ext in exts:
+        fun = task_gen.mappings[ext]
+
+        def stable_unity_fun(self, node, fun=fun):
+            path = node.path_from(self.path).replace('\\', '/')
+            digest = hashlib.md5(path.encode('utf-8')).digest()
+            bucket = jump_hash(int.from_bytes(digest[:8], 'little'), buckets)
+
+            batches = self.__dict__.setdefault('stable_unity_' + cls_name, dict())
+            if not bucket in batches:
+                batch = self.create_task('unity')
+                batch.outputs = [self.path.find_or_declare(
+                    'unity_%s_stable_%d.%s' % (self.idx, bucket, cls_name))]
+                batches[bucket] = batch
+
+                fun(self, batch.outputs[0])
+            #endif
+
+            batches[bucket].inputs.append(node)
+        #enddef
+
+        tgen.mappings[ext] = stable_unity_fun
+    #endfor
+#enddef
+
+# Replace unity's sequential batches with batches based on a hash of the source
+# path. Adding or removing a source then only changes the batch it belongs to,
+# instead of shifting every following source into another batch.
+@feature('unity')
+@after_method('single_gen')
+@before_method('process_source')
+def stable_unity(self):
+    if getattr(self, 'unity_partitioning', 'sequential') != 'stable':
+        return
+    #endif
+
+    size = self.batch_size()
+    if size <= 1:
+        return
+    #endif
+
+    buckets = getattr(self, 'unity_buckets', None)
+    if buckets == None:
+        known = get_unity_buckets(self.bld)
+
+        if not self.name in known:
+            sources = self.to_list(getattr(self, 'source', []))
+            known[self.name] = max(1, (len(sources) + size - 1) // size)
+        #endif
+
+        buckets = known[self.name]
+    #endif
+
+    features = self.to_list(self.features)
+    if 'c' in features:
+        bind_stable_unity(self, 'c', unity.EXTS_C, buckets)
+    #endif
+
+    if 'cxx' in features:
+        bind_stable_unity(self, 'cxx', unity.EXTS_CXX, buckets)
+    #endif
+#enddef
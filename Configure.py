@@ -1,23 +1,129 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-import sysconfig
+import sysconfig, time
 
+from waflib import Logs
+from waflib.TaskGen import feature, after_method
 from waflib.Tools.ccroot import USELIB_VARS
 
+from ArtifactCache import get_toolset_fingerprint
 from Common import *
+from Modules import configure_modules
+from SplitDwarf import configure_split_dwarf
+from Vendored import resolve_vendored
+
+# How the code fragment of a use flag is checked per use flag type.
+# link compiles and links an executable, syntax only checks if the fragment
+# compiles, and none skips the check. The first mode is the default.
+CHECK_MODES = {
+    'lib': ['link'],
+    'vendored': ['link'],
+    'headers': ['syntax', 'link'],
+    'flags': ['none', 'syntax']
+}
+
+# Compiler flags that stop after checking the syntax of a source file
+SYNTAX_ONLY_FLAGS = {'msvc': '/Zs'}
+
+# Compile the sources of a configure check without generating code or linking.
+# The compiler writes no output files, such as the object file or the .dwo file
+# of split DWARF, so empty ones are made for waf.
+@feature('syntax_only')
+@after_method('process_source')
+def syntax_only(self):
+    for tsk in getattr(self, 'compiled_tasks', []):
+        for env_flag, name in [('CFLAGS', tsk.env.CC_NAME), ('CXXFLAGS', tsk.env.CXX_NAME)]:
+            tsk.env.append_value(env_flag, [SYNTAX_ONLY_FLAGS.get(name, '-fsyntax-only')])
+        #endfor
+
+        def run_syntax_only(tsk=tsk, run=tsk.run):
+            ret = run()
+            if not ret:
+                for node in tsk.outputs:
+                    node.write('')
+                #endfor
+            #endif
+
+            return ret
+        #enddef
+
+        tsk.run = run_syntax_only
+    #endfor
+#enddef
+
+# Amount of use flags listed in the configure timing summary
+TIMING_REPORT_COUNT = 10
+
+# Print the slowest use flag checks and write all timings to the build directory
+def report_configure_timings(cfg, timings, read_time):
+    total = read_time + sum(timing['total'] for timing in timings.values())
+    slowest = sorted(
+        timings.items(),
+        key=lambda item: item[1]['total'],
+        reverse=True)[:TIMING_REPORT_COUNT]
+
+    Logs.pprint('CYAN', 'Configure report: %.3fs spent on use flags' % total)
+    Logs.pprint('CYAN', '  %-32s %8.3fs' % ('reading use flags file', read_time))
+    for use_flag, timing in slowest:
+        Logs.pprint(
+            'CYAN',
+            '  %-32s %8.3fs (read %.3fs, build %.3fs, resolve %.3fs, check %.3fs)'
+            % (use_flag,
+                timing['total'],
+                timing['read'],
+                timing['build'],
+                timing['resolve'],
+                timing['check']))
+    #endfor
+
+    report = {
+        'time': time.time(),
+        'toolset': cfg.env.cur_toolset,
+        'platform': cfg.env.cur_platform,
+        'configuration': cfg.env.cur_conf,
+        'total': total,
+        'read': read_time,
+        'use_flags': timings
+    }
+
+    file = os.path.join(cfg.bldnode.abspath(), 'configure_timings.json')
+    with open(file, 'w', encoding='utf-8') as report_file:
+        report_file.write(json.dumps(report, indent=4, sort_keys=True))
+    #endwith
+
+    # Keep one report per line so regressions can be tracked over time
+    file = os.path.join(cfg.bldnode.abspath(), 'configure_timings.history')
+    with open(file, 'a', encoding='utf-8') as history_file:
+        history_file.write(json.dumps(report, sort_keys=True) + '\n')
+    #endwith
+#enddef
 
 # Parse the use flags file and command line options
 def configure_use(cfg):
+    start = time.perf_counter()
     use = get_use(cfg)
+    read_time = time.perf_counter() - start
 
+    timings = dict()
     for use_flag in use:
-        configure_single_use(cfg, use, use_flag)
+        timing = configure_single_use(cfg, use, use_flag)
+
+        if timing != None:
+            timings[use_flag] = timing
+        #endif
     #endfor
+
+    report_configure_timings(cfg, timings, read_time)
 #enddef
 
 # Parse a single use flag and the corresponding command line options
+# Returns the time spent reading files, resolving flags and checking the flag,
+# or None if the use flag does not apply to the current configuration
 def configure_single_use(cfg, use, use_flag):
+    start = time.perf_counter()
+    read_time = 0.0
+
     type = str()
     if not 'type' in use[use_flag]:
         cfg.fatal(use_flag + ': Use flag type is required!')
@@ -45,8 +151,25 @@ def configure_single_use(cfg, use, use_flag):
             + ' block, where the type is not "flags"!')
     #endif
 
+    if not type in CHECK_MODES:
+        cfg.fatal(use_flag + ': Invalid use flag type "' + type \
+            + '", valid types are ' + str(list(CHECK_MODES)) + '!')
+    #endif
+
+    check = use[use_flag]['common'].get('check', CHECK_MODES[type][0])
+    if not check in CHECK_MODES[type]:
+        cfg.fatal(use_flag + ': Invalid check "' + check + '" for type "' + type \
+            + '", valid checks are ' + str(CHECK_MODES[type]) + '!')
+    #endif
+
+    if check != 'none' and not 'code' in use[use_flag]['common']:
+        cfg.fatal(use_flag \
+            + ': A "code" directive is required in a common' \
+            + ' block, where the use flag is checked!')
+    #endif
+
     if not cfg.options.target_platform in use[use_flag]['platforms']:
-        return
+        return None
     #endif
 
     optional = False
@@ -60,10 +183,20 @@ def configure_single_use(cfg, use, use_flag):
         optional = True
         if cfg.options.__dict__['without_' + use_flag] == True:
             cfg.msg('Checking for library <' + use_flag + '>', 'Disabled, skipping...', color='YELLOW')
-            return
+            return None
         #endif
     #endif
 
+    # Vendored sources are built first, after which they are checked as a library
+    build_time = 0.0
+    if type == 'vendored':
+        build_start = time.perf_counter()
+        use = dict(use)
+        use[use_flag] = resolve_vendored(cfg, use_flag, use[use_flag])
+        type = 'lib'
+        build_time = time.perf_counter() - build_start
+    #endif
+
     source = str()
 
     flags = dict()
@@ -82,13 +215,15 @@ def configure_single_use(cfg, use, use_flag):
         flags[toolset].setdefault('forced_includes', [])
     #endfor
 
-    if type != 'flags':
+    if check != 'none':
+        read_start = time.perf_counter()
         file = os.path.normcase(
             os.path.normpath(
                 os.path.join('UseFlags', use[use_flag]['common']['code'])))
         with open(file, encoding='utf-8') as source_file:
             source = source_file.read();
         #endwith
+        read_time += time.perf_counter() - read_start
     #endif
 
     for toolset in [cfg.env.cur_platform, cfg.env.cur_toolset, 'common']:
@@ -162,7 +297,9 @@ def configure_single_use(cfg, use, use_flag):
             flags[toolset]['includes'] = use[use_flag][toolset]['includes']
         #endif
 
+        read_start = time.perf_counter()
         current_toolset = get_toolset(cfg)
+        read_time += time.perf_counter() - read_start
         cur_conf = cfg.env.cur_conf
 
         def make_flags_absolute(relative_path):
@@ -261,7 +398,7 @@ def configure_single_use(cfg, use, use_flag):
         #endif
     #endfor
 
-    if not source and type != 'flags':
+    if not source and check != 'none':
         cfg.fatal('Source of test file for <' + use_flag + '> is empty.')
     #endif
 
@@ -324,6 +461,8 @@ def configure_single_use(cfg, use, use_flag):
         #endfor
     #endfor
 
+    check_start = time.perf_counter()
+
     if type == 'lib':
         if cfg.options.__dict__['with_' + use_flag] == 'dynamic':
             cfg.check_cxx(
@@ -354,6 +493,24 @@ def configure_single_use(cfg, use, use_flag):
                 msg='Checking for static library <' + use_flag + '>',
                 mandatory=not optional)
         #endif
+    elif type == 'headers' and check == 'syntax':
+        # Only the include paths and flags need to be correct, skip the link
+        result = cfg.check_cxx(
+            fragment=source,
+            features='cxx syntax_only',
+            use=use + [use_flag],
+            uselib_store=use_flag,
+            defines=defines,
+            cxxflags=cxx_flags,
+            cflags=cc_flags,
+            system_includes=includes,
+            msg='Checking for header only library <' + use_flag + '>',
+            mandatory=not optional)
+
+        # Link flags are only stored by checks that link
+        if result:
+            cfg.env['LDFLAGS_' + use_flag] = ld_flags
+        #endif
     elif type == 'headers': # header only lib
         cfg.check_cxx(
             fragment=source,
@@ -367,12 +524,67 @@ def configure_single_use(cfg, use, use_flag):
             msg='Checking for header only library <' + use_flag + '>',
             mandatory=not optional)
     elif type == 'flags':
-        cfg.msg('Adding extra flags for <' + use_flag + '>', '✔')
+        if check == 'syntax':
+            cfg.check_cxx(
+                fragment=source,
+                features='cxx syntax_only',
+                use=use,
+                defines=defines,
+                cxxflags=cxx_flags,
+                cflags=cc_flags,
+                system_includes=includes,
+                msg='Checking extra flags for <' + use_flag + '>')
+        else:
+            cfg.msg('Adding extra flags for <' + use_flag + '>', '✔')
+        #endif
+
         cfg.env['CFLAGS_' + use_flag] = cc_flags
         cfg.env['CXXFLAGS_' + use_flag] = cxx_flags
         cfg.env['LDFLAGS_' + use_flag] = ld_flags
         cfg.env['SYSINCLUDES_' + use_flag] = includes
     #endif
+
+    end = time.perf_counter()
+
+    return {
+        'type': type,
+        'read': read_time,
+        'build': build_time,
+        'resolve': check_start - start - read_time - build_time,
+        'check': end - check_start,
+        'total': end - start
+    }
+#enddef
+
+# Remap the top directory in debug info and macros, and create archives without
+# timestamps, so outputs are the same in every checkout
+def configure_reproducible(cfg):
+    if not cfg.options.reproducible:
+        return
+    #endif
+
+    cfg.env.REPRODUCIBLE = True
+    top = cfg.path.abspath()
+
+    if cfg.env.CXX_NAME == 'msvc':
+        for env_flag in ['CFLAGS', 'CXXFLAGS']:
+            cfg.env.append_value(env_flag, ['/Brepro', '/pathmap:' + top + '=.'])
+        #endfor
+
+        cfg.env.append_value('LINKFLAGS', ['/Brepro'])
+        cfg.env.append_value('ARFLAGS', ['/Brepro'])
+    else:
+        for env_flag in ['CFLAGS', 'CXXFLAGS']:
+            cfg.env.append_value(env_flag, ['-ffile-prefix-map=' + top + '=.'])
+        #endfor
+
+        # The D modifier makes ar write zero timestamps, uids and gids
+        if cfg.env.ARFLAGS and not 'D' in cfg.env.ARFLAGS[0]:
+            cfg.env.ARFLAGS = [cfg.env.ARFLAGS[0] + 'D'] + cfg.env.ARFLAGS[1:]
+        #endif
+    #endif
+
+    cfg.msg('Making reproducible builds', top + ' is mapped to .')
 #enddef
 
 # Standard waf configuration function, called when configure is passed
@@ -481,6 +693,13 @@ def configure(cfg: ConfigurationContext):
             cfg.env.SYSINCLUDES += flag
     #endfor
 
+    configure_reproducible(cfg)
+    configure_split_dwarf(cfg, toolset)
+    configure_modules(cfg, toolset)
+
+    # Identifies the compilers and toolset flags in artifact cache keys
+    cfg.env.TOOLSET_FINGERPRINT = get_toolset_fingerprint(cfg)
+
     # Configure use flags
     configure_use(cfg)
 #enddef
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os, shutil
+
+from waflib import Logs
+from waflib.Build import BuildContext
+
+# Entries at the top of the build directory that are never removed, these
+# belong to waf itself or are written by LotusWaf
+PROTECTED_ENTRIES = [
+    'c4che',
+    'config.log',
+    'compile_commands.json',
+    'configure_timings.json',
+    'configure_timings.history',
+    'test_history.json',
+    'source_index.json',
+    'source_index.json.tmp',
+    'artifact_cache_stats.json',
+    'time_trace',
+    'module_scan.json',
+    'affected_index.json',
+    'affected_state.json',
+    'unity_buckets.json',
+    'buildsystem_profile.prof',
+    'buildsystem_profile.txt'
+]
+
+PROTECTED_PREFIXES = ['.wafpickle', '.lock-waf']
+
+# Directories whose entries are caches, these are trimmed least recently used first
+CACHE_PREFIXES = ['.conf_check_', 'test_logs']
+
+def get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    #endif
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+            #endtry
+        #endfor
+    #endfor
+
+    return size
+#enddef
+
+def remove(path, dry_run):
+    if dry_run:
+        Logs.info('Would remove %s', path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+    #endif
+#enddef
+
+def is_protected(name):
+    return name in PROTECTED_ENTRIES \
+        or any(name.startswith(prefix) for prefix in PROTECTED_PREFIXES + CACHE_PREFIXES)
+#enddef
+
+# Remove the files in the build directory that no task produces anymore.
+# Files next to an output with the same name up to the extension, such as
+# dependency files and time traces, are kept with the output.
+def remove_stale_outputs(bld, dry_run):
+    outputs = set()
+    for group in bld.groups:
+        for tgen in group:
+            for tsk in getattr(tgen, 'tasks', []):
+                outputs.update(node.abspath() for node in tsk.outputs)
+            #endfor
+        #endfor
+    #endfor
+
+    stems = set(os.path.splitext(output)[0] for output in outputs)
+
+    removed = 0
+    size = 0
+    root = bld.bldnode.abspath()
+    for entry in os.listdir(root):
+        if is_protected(entry):
+            continue
+        #endif
+
+        path = os.path.join(root, entry)
+        candidates = [path]
+        if os.path.isdir(path):
+            candidates = []
+            for directory, dirs, files in os.walk(path):
+                candidates += [os.path.join(directory, name) for name in files]
+            #endfor
+        #endif
+
+        for file in candidates:
+            if file in outputs or os.path.splitext(file)[0] in stems:
+                continue
+            #endif
+
+            size += os.path.getsize(file)
+            removed += 1
+            remove(file, dry_run)
+        #endfor
+
+        # Remove directories that became empty
+        if os.path.isdir(path) and not dry_run:
+            for directory, dirs, files in os.walk(path, topdown=False):
+                if not os.listdir(directory):
+                    os.rmdir(directory)
+                #endif
+            #endfor
+        #endif
+    #endfor
+
+    return removed, size
+#enddef
+
+# Trim the cache directories to max_size, least recently used entries first
+def trim_caches(bld, max_size, dry_run):
+    root = bld.bldnode.abspath()
+
+    entries = []
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+
+        if entry.startswith('.conf_check_'):
+            entries.append(path)
+        elif entry in CACHE_PREFIXES and os.path.isdir(path):
+            entries += [os.path.join(path, name) for name in os.listdir(path)]
+        #endif
+    #endfor
+
+    entries = [(os.path.getmtime(path), get_size(path), path) for path in entries]
+    total = sum(size for mtime, size, path in entries)
+
+    removed = 0
+    size = 0
+    for mtime, entry_size, path in sorted(entries):
+        if total <= max_size:
+            break
+        #endif
+
+        remove(path, dry_run)
+        total -= entry_size
+        size += entry_size
+        removed += 1
+    #endfor
+
+    return removed, size
+#enddef
+
+def collect_garbage(bld):
+    dry_run = bld.options.gc_dry_run
+
+    stale, stale_size = remove_stale_outputs(bld, dry_run)
+    cached, cached_size = trim_caches(bld, bld.options.gc_cache_size * 1024 * 1024, dry_run)
+
+    Logs.pprint(
+        'CYAN',
+        'Garbage collection: %s %d stale outputs (%.1f MiB) and %d cache entries (%.1f MiB)'
+        % ('would remove' if dry_run else 'removed',
+            stale,
+            stale_size / (1024 * 1024),
+            cached,
+            cached_size / (1024 * 1024)))
+#enddef
+
+# Collect garbage after a build when --auto-gc is passed. Only builds of every
+# target know all outputs, so builds of specific targets are skipped, as are
+# builds that posted no projects at all, such as --affected without changes.
+def auto_collect_garbage(bld):
+    if bld.targets and bld.targets != '*':
+        return
+    #endif
+
+    if not any(getattr(tgen, 'posted', False) for tgen in bld.get_all_task_gen()):
+        return
+    #endif
+
+    collect_garbage(bld)
+#enddef
+
+def enable_auto_gc(bld):
+    if bld.options.auto_gc:
+        bld.add_post_fun(auto_collect_garbage)
+    #endif
+#enddef
+
+class GcContext(BuildContext):
+    '''Remove build outputs that no project produces anymore and trim caches'''
+    cmd = 'gc'
+    fun = 'build'
+
+    # Create the tasks of every project to learn their outputs, but run none
+    def execute_build(self):
+        Logs.info("Waf: Entering directory `%s'", self.variant_dir)
+        self.recurse([self.run_dir])
+
+        for i, group in enumerate(self.groups):
+            self.current_group = i
+            for tgen in group:
+                tgen.post()
+            #endfor
+        #endfor
+
+        collect_garbage(self)
+        Logs.info("Waf: Leaving directory `%s'", self.variant_dir)
+    #enddef
+#endclass
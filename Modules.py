@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import hashlib, json, os, re, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from waflib import Logs, Task, Utils
+from waflib.TaskGen import extension, feature, after_method
+
+# Compilers that support C++20 modules and dependency scanning
+MODULE_COMPILERS = ['gcc', 'clang']
+
+# Extensions of module interface units
+MODULE_EXTENSIONS = ['.cppm', '.ixx', '.mpp']
+
+# Amount of sources scanned in parallel while posting a project
+SCAN_JOBS = os.cpu_count() or 1
+
+# The compilers don't recognise all of these extensions as C++, gcc passes them
+# to the linker, so the language is set before the source
+@extension(*MODULE_EXTENSIONS)
+def module_interface_file(self, node):
+    tsk = self.create_compiled_task('cxx', node)
+
+    language = 'c++-module' if self.env.CXX_NAME == 'clang' else 'c++'
+    tsk.env.append_value('CXXFLAGS', ['-x', language])
+    return tsk
+#enddef
+
+# Compiles a header unit, the flags contain the source and the output
+class cxx_header_unit(Task.Task):
+    run_str = '${CXX} ${HEADER_UNIT_FLAGS}'
+    color = 'GREEN'
+#endclass
+
+# Enable modules when the toolset sets "modules" to true
+def configure_modules(cfg, toolset):
+    if not toolset.get('modules', False):
+        return
+    #endif
+
+    if not cfg.env.CXX_NAME in MODULE_COMPILERS:
+        cfg.fatal('C++20 modules are only supported by gcc and clang toolsets.')
+    #endif
+
+    if cfg.env.CXX_NAME == 'clang':
+        cfg.find_program(toolset.get('scan_deps_path', 'clang-scan-deps'), var='SCAN_DEPS')
+    #endif
+
+    cfg.env.CXX_MODULES = True
+    cfg.msg('Using C++20 modules', cfg.env.CXX_NAME)
+#enddef
+
+def get_bmi_extension(env):
+    return '.pcm' if env.CXX_NAME == 'clang' else '.gcm'
+#enddef
+
+# The flags used to compile a source, without the source and output
+def get_compile_flags(tsk):
+    env = tsk.env
+    flags = list(env.CXXFLAGS)
+    flags += [env.DEFINES_ST % define for define in env.DEFINES]
+    flags += [env.CPPPATH_ST % path for path in env.INCPATHS]
+
+    for path in env.SYSINCLUDES:
+        flags += ['-isystem', path]
+    #endfor
+
+    return flags
+#enddef
+
+# Return the P1689 rules of a source file
+def scan_source(tsk, flags):
+    env = tsk.env
+    source = tsk.inputs[0].abspath()
+    obj = tsk.outputs[0].abspath()
+
+    if env.CXX_NAME == 'clang':
+        command = Utils.to_list(env.SCAN_DEPS) + ['-format=p1689', '--'] \
+            + Utils.to_list(env.CXX) + flags + ['-c', source, '-o', obj]
+        out = tsk.generator.bld.cmd_and_log(command)
+        return json.loads(out)['rules']
+    #endif
+
+    scratch = tempfile.mkdtemp(prefix='lotus-scan-')
+    try:
+        ddi = os.path.join(scratch, 'scan.ddi')
+        command = Utils.to_list(env.CXX) + flags + [
+            '-fmodules-ts',
+            '-E',
+            '-x', 'c++', source,
+            '-fdeps-format=p1689r5',
+            '-fdeps-file=' + ddi,
+            '-fdeps-target=' + obj,
+            '-MD', '-MF', os.path.join(scratch, 'scan.d'),
+            '-o', os.path.join(scratch, 'scan.i')
+        ]
+        tsk.generator.bld.cmd_and_log(command)
+
+        with open(ddi, encoding='utf-8') as ddi_file:
+            return json.loads(ddi_file.read())['rules']
+        #endwith
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    #endtry
+#enddef
+
+# Scan results of previous builds, valid as long as the source and flags match
+def get_scan_cache(bld):
+    cache = getattr(bld, 'module_scan_cache', None)
+    if cache != None:
+        return cache
+    #endif
+
+    cache = bld.module_scan_cache = dict()
+
+    file = os.path.join(bld.bldnode.abspath(), 'module_scan.json')
+    if os.path.isfile(file):
+        with open(file, encoding='utf-8') as cache_file:
+            cache.update(json.loads(cache_file.read()))
+        #endwith
+    #endif
+
+    def save_scan_cache(bld):
+        with open(file, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(json.dumps(bld.module_scan_cache))
+        #endwith
+    #enddef
+
+    bld.add_post_fun(save_scan_cache)
+    return cache
+#enddef
+
+# The rules also depend on the included headers, which may import modules too.
+# These are the includes waf found in the previous build, when the includes
+# change the signature changes with them.
+def get_scan_rules(tsk):
+    bld = tsk.generator.bld
+    cache = get_scan_cache(bld)
+    source = tsk.inputs[0]
+    flags = get_compile_flags(tsk)
+
+    hasher = hashlib.md5(source.read('rb'))
+    hasher.update(repr(flags).encode('utf-8'))
+
+    for node in bld.node_deps.get(tsk.uid(), []):
+        hasher.update(node.abspath().encode('utf-8'))
+        hasher.update(node.get_bld_sig())
+    #endfor
+
+    signature = hasher.hexdigest()
+
+    entry = cache.get(source.abspath())
+    if entry != None and entry['signature'] == signature:
+        return entry['rules']
+    #endif
+
+    rules = scan_source(tsk, flags)
+    cache[source.abspath()] = {'signature': signature, 'rules': rules}
+    return rules
+#enddef
+
+def get_bmi_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+#enddef
+
+# Create the task that compiles a header unit, once per header and set of
+# compile flags per build. A header unit depends on the macros and flags it is
+# compiled with, so projects with other flags get their own.
+def get_header_unit(tgen, tsk, path):
+    bld = tgen.bld
+    env = tsk.env
+    flags = get_compile_flags(tsk)
+
+    hasher = hashlib.md5(path.encode('utf-8'))
+    hasher.update(repr(flags).encode('utf-8'))
+    digest = hasher.hexdigest()[:16]
+
+    units = bld.__dict__.setdefault('header_units', dict())
+    if digest in units:
+        return units[digest]
+    #endif
+
+    node = bld.bldnode.find_or_declare(
+        ['header_units', digest + '_' + get_bmi_name(os.path.basename(path)) + get_bmi_extension(env)])
+
+    unit = tgen.create_task('cxx_header_unit', [], [node])
+    unit.env = env.derive()
+
+    header = bld.root.find_node(path)
+    if header:
+        unit.dep_nodes.append(header)
+    #endif
+
+    if env.CXX_NAME == 'clang':
+        flags += ['-fmodule-header', '-xc++-header', path, '-o', node.abspath()]
+    else:
+        mapper = node.change_ext('.map')
+        mapper.write('%s %s\n' % (path, node.abspath()))
+        flags += [
+            '-fmodules-ts',
+            '-fmodule-mapper=' + mapper.abspath(),
+            '-fmodule-header',
+            '-xc++-header',
+            path
+        ]
+    #endif
+
+    unit.env.HEADER_UNIT_FLAGS = flags
+    units[digest] = (path, unit, node)
+    return units[digest]
+#enddef
+
+# The module interfaces of a task generator and the projects it uses
+def get_visible_modules(self):
+    modules = dict()
+
+    for name in getattr(self, 'tmp_use_seen', []):
+        try:
+            y = self.bld.get_tgen_by_name(name)
+        except Exception:
+            continue
+        #endtry
+
+        modules.update(getattr(y, 'export_modules', {}))
+    #endfor
+
+    return modules
+#enddef
+
+# Add the requires of a module, and the modules these require, to result
+def add_transitive(modules, name, result):
+    if name in result or not name in modules:
+        return
+    #endif
+
+    result[name] = modules[name]
+    for required in modules[name]['requires']:
+        add_transitive(modules, required, result)
+    #endfor
+#enddef
+
+# Scan the sources of a project for module imports and exports. Tasks producing
+# a module interface are ordered before the tasks importing it, and the
+# interfaces are exported to projects that use this one.
+@feature('cxxmodules')
+@after_method('process_source', 'process_use', 'propagate_uselib_vars', 'apply_incpaths')
+def process_modules(self):
+    if not self.env.CXX_MODULES:
+        self.bld.fatal(self.name + ': Modules are not enabled in the toolset.')
+    #endif
+
+    tasks = [tsk for tsk in getattr(self, 'compiled_tasks', []) \
+        if tsk.__class__.__name__ == 'cxx']
+
+    # Load the cache before scanning, the sources are scanned from several threads
+    get_scan_cache(self.bld)
+
+    with ThreadPoolExecutor(SCAN_JOBS) as executor:
+        results = list(executor.map(get_scan_rules, tasks))
+    #endwith
+
+    ext = get_bmi_extension(self.env)
+    modules = get_visible_modules(self)
+    own_modules = dict()
+
+    for tsk, rules in zip(tasks, results):
+        for rule in rules:
+            requires = [required['logical-name'] for required in rule.get('requires', [])]
+
+            for provided in rule.get('provides', []):
+                name = provided['logical-name']
+                node = tsk.outputs[0].parent.find_or_declare(
+                    '%s.%d%s' % (get_bmi_name(name), self.idx, ext))
+                tsk.outputs.append(node)
+                own_modules[name] = {'task': tsk, 'node': node, 'requires': requires}
+            #endfor
+        #endfor
+    #endfor
+
+    modules.update(own_modules)
+
+    for tsk, rules in zip(tasks, results):
+        imports = dict()
+        header_units = []
+
+        for rule in rules:
+            for required in rule.get('requires', []):
+                if 'lookup-method' in required:
+                    header_units.append(get_header_unit(self, tsk, required['source-path']))
+                elif required['logical-name'] in modules:
+                    add_transitive(modules, required['logical-name'], imports)
+                else:
+                    Logs.warn('%s: module %s imported by %s is not provided by any used project'
+                        % (self.name, required['logical-name'], tsk.inputs[0]))
+                #endif
+            #endfor
+        #endfor
+
+        for name in imports:
+            if imports[name]['task'] is not tsk:
+                tsk.set_run_after(imports[name]['task'])
+                tsk.dep_nodes.append(imports[name]['node'])
+            #endif
+        #endfor
+
+        for path, unit, node in header_units:
+            tsk.set_run_after(unit)
+            tsk.dep_nodes.append(node)
+        #endfor
+
+        provided = [name for name in own_modules if own_modules[name]['task'] is tsk]
+
+        if self.env.CXX_NAME == 'clang':
+            flags = ['-fmodule-file=%s=%s' % (name, imports[name]['node'].abspath()) \
+                for name in sorted(imports) if not name in provided]
+            flags += ['-fmodule-file=%s' % node.abspath() for path, unit, node in header_units]
+
+            for name in provided:
+                flags.append('-fmodule-output=%s' % own_modules[name]['node'].abspath())
+            #endfor
+        else:
+            lines = ['%s %s' % (name, imports[name]['node'].abspath()) for name in sorted(imports)]
+            lines += ['%s %s' % (name, own_modules[name]['node'].abspath()) for name in provided]
+            lines += ['%s %s' % (path, node.abspath()) for path, unit, node in header_units]
+
+            mapper = tsk.outputs[0].change_ext('.map')
+            mapper.write('\n'.join(sorted(set(lines))) + '\n')
+            flags = ['-fmodules-ts', '-fmodule-mapper=' + mapper.abspath()]
+        #endif
+
+        tsk.env.append_value('CXXFLAGS', flags)
+    #endfor
+
+    self.export_modules = own_modules
+#enddef
@@ -4,6 +4,8 @@
 import argparse
 
 from Common import *
+from Profiling import start_buildsystem_profile
+from Vendored import DEFAULT_VENDOR_STORE
 
 # Show general help output when waf --help is executed
 def load_configuration_options(config, opt):
@@ -41,6 +43,24 @@ def load_configuration_options(config, opt):
         + 'Valid configurations are %r [default: %s]'
         % (config['configurations'], config['configurations'][0]))
 
+    opt.add_option(
+        '--reproducible',
+        action='store_true',
+        dest='reproducible',
+        default=False,
+        help='Remap the checkout path in outputs and create deterministic ' \
+        + 'archives, so builds of different checkouts produce the same ' \
+        + 'outputs and share artifact cache entries.')
+
+    vendor_store = os.environ.get('LOTUS_VENDOR_STORE', DEFAULT_VENDOR_STORE)
+    opt.add_option(
+        '--vendor-store',
+        action='store',
+        dest='vendor_store',
+        default=vendor_store,
+        help='Directory in which vendored use flags are built, shared between ' \
+        + 'build directories and branches. [default: %s]' % vendor_store)
+
     toolset_help = 'R|Select the toolset to use for compiling. Valid toolsets are:\n'
     for _platform in config['toolsets']:
         toolset_help = toolset_help + '{\n\tplatform: ' + _platform + ': '
@@ -159,6 +179,143 @@ def load_use_options(config, opt):
     #endfor
 #enddef
 
+# Show build specific help output when waf --help is executed
+def load_build_options(opt):
+    group = opt.add_option_group('Build options')
+
+    group.add_option(
+        '--link-jobs',
+        action='store',
+        type='int',
+        dest='link_jobs',
+        default=None,
+        help='Maximum amount of shared library and executable links that run ' \
+        + 'at the same time, compile tasks are not affected. 0 means no limit. ' \
+        + '[default: link_jobs in the toolset file, or no limit]')
+
+    group.add_option(
+        '--fail-fast',
+        action='store_true',
+        dest='fail_fast',
+        default=False,
+        help='Stop running the remaining tests after the first test failure.')
+
+    group.add_option(
+        '--affected',
+        action='store_true',
+        dest='affected',
+        default=False,
+        help='Only build and run the tests that depend on changed files, ' \
+        + 'directly or through use. Changes are taken from git when ' \
+        + '--affected-base is passed, otherwise from the file contents ' \
+        + 'when the tests last ran.')
+
+    group.add_option(
+        '--affected-base',
+        action='store',
+        dest='affected_base',
+        default=None,
+        help='Git revision to compare against with --affected, e.g. origin/main.')
+
+    group.add_option(
+        '--adaptive-jobs',
+        action='store_true',
+        dest='adaptive_jobs',
+        default=False,
+        help='Start fewer tasks in parallel while the system load is high ' \
+        + 'or available memory is low, up to --max-jobs tasks.')
+
+    group.add_option(
+        '--max-jobs',
+        action='store',
+        type='int',
+        dest='max_jobs',
+        default=None,
+        help='Maximum amount of parallel tasks with --adaptive-jobs. ' \
+        + '[default: the value of -j]')
+
+    group.add_option(
+        '--unity-partitioning',
+        action='store',
+        dest='unity_partitioning',
+        default=None,
+        choices=['sequential', 'stable'],
+        help='Select how sources are divided over unity batches. sequential ' \
+        + 'fills batches in source order, stable assigns sources to batches ' \
+        + 'by a hash of their path, so adding or removing a source only ' \
+        + 'rebuilds its own batch. ' \
+        + '[default: unity_partitioning in the project file, or sequential]')
+
+    group.add_option(
+        '--profile-buildsystem',
+        action='store_true',
+        dest='profile_buildsystem',
+        default=False,
+        help='Profile the Python code of the build system and write a report ' \
+        + 'per phase and per LotusWaf function to buildsystem_profile.txt ' \
+        + 'in the build directory.')
+
+    group.add_option(
+        '--auto-gc',
+        action='store_true',
+        dest='auto_gc',
+        default=False,
+        help='Run the gc command after every build of all targets.')
+
+    group.add_option(
+        '--gc-cache-size',
+        action='store',
+        type='int',
+        dest='gc_cache_size',
+        default=1024,
+        help='Size limit in MiB of the configure check directories and test ' \
+        + 'logs in the build directory, enforced by gc. [default: %d]' % 1024)
+
+    group.add_option(
+        '--gc-dry-run',
+        action='store_true',
+        dest='gc_dry_run',
+        default=False,
+        help='List what gc would remove without removing anything.')
+
+    group.add_option(
+        '--artifact-cache',
+        action='store',
+        dest='artifact_cache',
+        default=os.environ.get('LOTUS_ARTIFACT_CACHE'),
+        help='Share object files and linked outputs between builds through a ' \
+        + 'directory (local or NFS) or a http(s):// URL of a store that ' \
+        + 'supports GET and PUT, such as waf artifact_cache_server. ' \
+        + '[default: $LOTUS_ARTIFACT_CACHE, or disabled]')
+
+    group.add_option(
+        '--artifact-cache-size',
+        action='store',
+        type='int',
+        dest='artifact_cache_size',
+        default=10240,
+        help='Size limit of the artifact cache in MiB, the least recently ' \
+        + 'used entries are removed when exceeded. [default: %d]' % 10240)
+
+    group.add_option(
+        '--artifact-cache-port',
+        action='store',
+        type='int',
+        dest='artifact_cache_port',
+        default=8080,
+        help='Port used by waf artifact_cache_server. [default: %d]' % 8080)
+
+    group.add_option(
+        '--time-trace',
+        action='store_true',
+        dest='time_trace',
+        default=False,
+        help='Profile compilation with -ftime-trace (clang toolsets only) and ' \
+        + 'report the slowest translation units, most expensive headers and ' \
+        + 'template instantiations per project. The reports are kept in ' \
+        + 'the time_trace directory of the build directory.')
+#enddef
+
 class SmartFormatter(argparse.HelpFormatter):
     def _split_lines(self, text: str, width):
         if text.startswith('R|'):
@@ -171,6 +328,11 @@ class SmartFormatter(argparse.HelpFormatter):
 
 # Standard waf options function, called when --help is passed
 def options(opt: OptionsContext):
+    # Checked before the command line is parsed, so parsing is profiled as well
+    if '--profile-buildsystem' in sys.argv:
+        start_buildsystem_profile()
+    #endif
+
     opt.load('unity waf_unit_test')
     opt.load('clang_compilation_database')
     opt.parser.remove_option('--alltests')
@@ -196,4 +358,5 @@ def options(opt: OptionsContext):
 
     load_configuration_options(config, opt)
     load_use_options(config, opt)
+    load_build_options(opt)
 #enddef
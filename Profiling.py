@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import atexit, cProfile, io, os, pstats, sys
+
+from waflib import Context
+
+# Amount of LotusWaf functions listed in the report
+PROFILE_REPORT_COUNT = 30
+
+# The functions that mark a phase, the cumulative time of a phase is the time
+# spent in its functions and everything they call
+PHASES = [
+    ('options', [('Options.py', 'parse_args'), ('Options.py', 'options')]),
+    ('configure', [('Configure.py', 'configure')]),
+    ('recurse', [('Context.py', 'recurse')]),
+    ('project loading', [('Build.py', 'project')]),
+    ('posting', [('TaskGen.py', 'post')]),
+    ('signature computation', [('Task.py', 'signature')]),
+    ('execution', [('Runner.py', 'start')]),
+    ('storing', [('Build.py', 'store')])
+]
+
+LOTUS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def get_phase_times(stats):
+    times = []
+
+    for phase, functions in PHASES:
+        total = 0.0
+        for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+            if (os.path.basename(filename), name) in functions:
+                total += ct
+            #endif
+        #endfor
+
+        times.append((phase, total))
+    #endfor
+
+    return times
+#enddef
+
+def write_report(profiler):
+    profiler.disable()
+
+    out_dir = Context.out_dir or os.path.join(Context.top_dir or os.getcwd(), 'build')
+    os.makedirs(out_dir, exist_ok=True)
+
+    profiler.dump_stats(os.path.join(out_dir, 'buildsystem_profile.prof'))
+    stats = pstats.Stats(profiler)
+
+    report = io.StringIO()
+    report.write('Build system profile of: %s\n\n' % ' '.join(sys.argv))
+    report.write('Total time: %.3fs\n\n' % stats.total_tt)
+
+    # The phases are nested, e.g. project loading happens during recurse
+    report.write('Cumulative time per phase:\n')
+    for phase, total in get_phase_times(stats):
+        report.write('  %-24s %8.3fs\n' % (phase, total))
+    #endfor
+
+    lotus = [(key, value) for key, value in stats.stats.items() \
+        if os.path.dirname(os.path.abspath(key[0])) == LOTUS_DIR]
+
+    for title, index in [('cumulative', 3), ('own', 2)]:
+        report.write('\nLotusWaf functions by %s time:\n' % title)
+        report.write('  %10s %10s %10s  %s\n' % ('calls', 'own', 'cumulative', 'function'))
+
+        top = sorted(lotus, key=lambda item: item[1][index], reverse=True)
+        for (filename, line, name), (cc, nc, tt, ct, callers) in top[:PROFILE_REPORT_COUNT]:
+            report.write('  %10d %9.3fs %9.3fs  %s:%d(%s)\n'
+                % (nc, tt, ct, os.path.basename(filename), line, name))
+        #endfor
+    #endfor
+
+    report.write('\nAll functions by cumulative time:\n')
+    stats.stream = report
+    stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_COUNT)
+
+    with open(os.path.join(out_dir, 'buildsystem_profile.txt'), 'w', encoding='utf-8') as report_file:
+        report_file.write(report.getvalue())
+    #endwith
+#enddef
+
+# Profile the rest of this waf invocation, the report is written on exit.
+# This starts before the command line is parsed, so the options are profiled too.
+def start_buildsystem_profile():
+    profiler = cProfile.Profile()
+    atexit.register(write_report, profiler)
+    profiler.enable()
+#enddef
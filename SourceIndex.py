@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import fnmatch, json, os
+
+from waflib import Logs
+
+# Characters that make a source entry a glob pattern
+GLOB_CHARACTERS = '*?['
+
+def is_glob(pattern):
+    return any(c in pattern for c in GLOB_CHARACTERS)
+#enddef
+
+# On-disk cache of directory listings used to expand glob patterns in sources.
+# A listing is only read again when the modification time of its directory
+# changed, so large source trees are not walked in full on every build.
+class SourceIndex(object):
+    def __init__(self, file):
+        self.file = file
+        self.entries = dict()
+        self.dirty = False
+
+        if os.path.isfile(file):
+            try:
+                with open(file, encoding='utf-8') as index_file:
+                    self.entries = json.loads(index_file.read())
+                #endwith
+            except ValueError:
+                Logs.debug('source_index: ignoring corrupt index %s', file)
+            #endtry
+        #endif
+    #enddef
+
+    def list_dir(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        #endtry
+
+        entry = self.entries.get(directory)
+        if entry != None and entry['mtime'] == mtime:
+            return entry
+        #endif
+
+        dirs = []
+        files = []
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    dirs.append(dir_entry.name)
+                else:
+                    files.append(dir_entry.name)
+                #endif
+            #endfor
+        #endwith
+
+        entry = {'mtime': mtime, 'dirs': sorted(dirs), 'files': sorted(files)}
+        self.entries[directory] = entry
+        self.dirty = True
+
+        return entry
+    #enddef
+
+    def match(self, directory, relative, segments, results):
+        segment = segments[0]
+        rest = segments[1:]
+
+        if segment in ['', '.', '..'] or (rest and not is_glob(segment)):
+            if rest:
+                self.match(
+                    os.path.join(directory, segment),
+                    relative + segment + '/',
+                    rest,
+                    results)
+            #endif
+
+            return
+        #endif
+
+        entry = self.list_dir(directory)
+        if entry == None:
+            return
+        #endif
+
+        if segment == '**':
+            if rest:
+                self.match(directory, relative, rest, results)
+            #endif
+
+            for name in entry['dirs']:
+                if not name.startswith('.'):
+                    self.match(
+                        os.path.join(directory, name),
+                        relative + name + '/',
+                        segments,
+                        results)
+                #endif
+            #endfor
+
+            return
+        #endif
+
+        names = entry['dirs'] if rest else entry['files']
+        for name in fnmatch.filter(names, segment):
+            if name.startswith('.') and not segment.startswith('.'):
+                continue
+            #endif
+
+            if rest:
+                self.match(
+                    os.path.join(directory, name),
+                    relative + name + '/',
+                    rest,
+                    results)
+            else:
+                results.append(relative + name)
+            #endif
+        #endfor
+    #enddef
+
+    # Return the files matching pattern, relative to base and in sorted order
+    def glob(self, base, pattern):
+        results = []
+        self.match(base, '', pattern.replace('\\', '/').split('/'), results)
+        return sorted(set(results))
+    #enddef
+
+    def save(self):
+        if not self.dirty:
+            return
+        #endif
+
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as index_file:
+            index_file.write(json.dumps(self.entries))
+        #endwith
+
+        os.replace(tmp, self.file)
+        self.dirty = False
+    #enddef
+#endclass
+
+# Return the source index of a build, it is saved before the build starts
+def get_source_index(bld):
+    index = getattr(bld, 'source_index', None)
+
+    if index == None:
+        bld.bldnode.mkdir()
+        index = bld.source_index = SourceIndex(
+            os.path.join(bld.bldnode.abspath(), 'source_index.json'))
+        bld.add_pre_fun(lambda bld: bld.source_index.save())
+    #endif
+
+    return index
+#enddef
+
+# Replace the glob patterns in a list of sources by the files they match
+def expand_source_globs(bld, base, sources):
+    expanded = []
+
+    for source in sources:
+        if not isinstance(source, str) or not is_glob(source):
+            expanded.append(source)
+            continue
+        #endif
+
+        matches = get_source_index(bld).glob(base, source)
+        if not matches:
+            Logs.debug('source_index: %r in %s matches no files', source, base)
+        #endif
+
+        expanded += matches
+    #endfor
+
+    return expanded
+#enddef
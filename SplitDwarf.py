@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+from waflib import Logs, Task
+from waflib.TaskGen import feature, after_method
+
+# Compilers that support -gsplit-dwarf
+SPLIT_DWARF_COMPILERS = ['gcc', 'clang']
+
+# Packages the .dwo files of a linked binary into a single .dwp file
+class dwp(Task.Task):
+    run_str = '${DWP} -e ${SRC[0].abspath()} -o ${TGT[0].abspath()}'
+    color = 'BLUE'
+#endclass
+
+# Read a boolean toolset option, which may be overridden per configuration
+def read_toolset_switch(cfg, toolset, option):
+    return toolset.get(option + '_' + cfg.env.cur_conf, toolset.get(option, False))
+#enddef
+
+# Enable split DWARF when the toolset sets "split_dwarf" to true.
+# Optionally package the debug info of linked binaries with dwp when "dwp" is true.
+def configure_split_dwarf(cfg, toolset):
+    if not read_toolset_switch(cfg, toolset, 'split_dwarf'):
+        return
+    #endif
+
+    if cfg.env.DEST_OS != 'linux' \
+            or not cfg.env.CC_NAME in SPLIT_DWARF_COMPILERS \
+            or not cfg.env.CXX_NAME in SPLIT_DWARF_COMPILERS:
+        Logs.warn('Split DWARF is only supported by gcc and clang on linux, ignoring it.')
+        return
+    #endif
+
+    cfg.env.SPLIT_DWARF = True
+    cfg.env.append_value('CFLAGS', ['-gsplit-dwarf'])
+    cfg.env.append_value('CXXFLAGS', ['-gsplit-dwarf'])
+
+    # Needed for LTO, where the debug info is generated at link time
+    cfg.env.append_value('LINKFLAGS', ['-gsplit-dwarf'])
+
+    # For example -fuse-ld=lld and -Wl,--gdb-index
+    cfg.env.append_value('LINKFLAGS', toolset.get('split_dwarf_ld_flags', []))
+    cfg.env.append_value(
+        'LINKFLAGS',
+        toolset.get('split_dwarf_ld_flags_' + cfg.env.cur_conf, []))
+
+    if read_toolset_switch(cfg, toolset, 'dwp'):
+        cfg.find_program(toolset.get('dwp_path', 'dwp'), var='DWP')
+        cfg.env.SPLIT_DWARF_DWP = True
+    #endif
+
+    cfg.msg('Using split DWARF', 'dwp' if cfg.env.SPLIT_DWARF_DWP else 'yes')
+#enddef
+
+# The compiler writes a .dwo file next to every object file, declare them as
+# outputs so they are cleaned and rebuilt with the object files
+@feature('c', 'cxx')
+@after_method('process_source')
+def split_dwarf_outputs(self):
+    if not self.env.SPLIT_DWARF:
+        return
+    #endif
+
+    for tsk in getattr(self, 'compiled_tasks', []):
+        tsk.outputs.append(tsk.outputs[0].change_ext('.dwo'))
+    #endfor
+#enddef
+
+@feature('cprogram', 'cxxprogram', 'cshlib', 'cxxshlib')
+@after_method('apply_link', 'split_dwarf_outputs')
+def split_dwarf_package(self):
+    if not self.env.SPLIT_DWARF_DWP or not getattr(self, 'link_task', None):
+        return
+    #endif
+
+    binary = self.link_task.outputs[0]
+
+    # Other features add outputs too, such as the interfaces of C++20 modules
+    dwo_files = [node for tsk in getattr(self, 'compiled_tasks', []) \
+        for node in tsk.outputs if node.name.endswith('.dwo')]
+
+    self.dwp_task = self.create_task(
+        'dwp',
+        [binary] + dwo_files,
+        binary.parent.find_or_declare(binary.name + '.dwp'))
+#enddef
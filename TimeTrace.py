@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json, os, time
+
+from waflib import Logs
+
+# Amount of entries listed per category in the time trace report
+TIME_TRACE_REPORT_COUNT = 10
+
+# Trace events of template instantiations
+INSTANTIATION_EVENTS = ['InstantiateClass', 'InstantiateFunction']
+
+# Clang writes the trace next to the object file, with a .json extension
+def get_trace_path(obj):
+    return os.path.splitext(obj.abspath())[0] + '.json'
+#enddef
+
+def read_trace(path):
+    try:
+        with open(path, encoding='utf-8') as trace_file:
+            return json.loads(trace_file.read()).get('traceEvents', [])
+        #endwith
+    except (OSError, ValueError):
+        return None
+    #endtry
+#enddef
+
+def add_time(times, key, duration):
+    times[key] = times.get(key, 0) + duration
+#enddef
+
+def get_top(times):
+    top = sorted(times.items(), key=lambda item: item[1], reverse=True)
+    return [[key, duration / 1e6] for key, duration in top[:TIME_TRACE_REPORT_COUNT]]
+#enddef
+
+# Sum the traces of every translation unit of a task generator.
+# Header times include the headers they include themselves.
+def collect_project(tgen):
+    units = dict()
+    headers = dict()
+    instantiations = dict()
+
+    for tsk in getattr(tgen, 'compiled_tasks', []):
+        events = read_trace(get_trace_path(tsk.outputs[0]))
+        if events == None:
+            continue
+        #endif
+
+        unit = tsk.inputs[0].abspath()
+        for event in events:
+            name = event.get('name')
+            duration = event.get('dur', 0)
+
+            if name == 'ExecuteCompiler':
+                add_time(units, unit, duration)
+            elif name == 'Source':
+                add_time(headers, event['args']['detail'], duration)
+            elif name in INSTANTIATION_EVENTS:
+                add_time(instantiations, event['args']['detail'], duration)
+            #endif
+        #endfor
+    #endfor
+
+    return {
+        'total': sum(units.values()) / 1e6,
+        'units': len(units),
+        'slowest_units': get_top(units),
+        'expensive_headers': get_top(headers),
+        'instantiations': get_top(instantiations)
+    }
+#enddef
+
+# Collect the clang time traces of all projects, print the report, compare it
+# to the previous build and add it to the history in the build directory
+def report_time_trace(bld):
+    projects = dict()
+    for tgen in bld.get_all_task_gen():
+        if getattr(tgen, 'compiled_tasks', None):
+            projects[tgen.name] = collect_project(tgen)
+        #endif
+    #endfor
+
+    trace_dir = os.path.join(bld.bldnode.abspath(), 'time_trace')
+    os.makedirs(trace_dir, exist_ok=True)
+
+    history_file = os.path.join(trace_dir, 'history.jsonl')
+    previous = dict()
+    if os.path.isfile(history_file):
+        with open(history_file, encoding='utf-8') as history:
+            for line in history:
+                previous = json.loads(line)['projects']
+            #endfor
+        #endwith
+    #endif
+
+    for name in sorted(projects, key=lambda name: projects[name]['total'], reverse=True):
+        project = projects[name]
+
+        change = ''
+        if name in previous:
+            change = ' (%+.2fs)' % (project['total'] - previous[name]['total'])
+        #endif
+
+        Logs.pprint(
+            'CYAN',
+            'Compile time of %s: %.2fs over %d translation units%s'
+            % (name, project['total'], project['units'], change))
+
+        for title, key in [
+                ('Slowest translation units', 'slowest_units'),
+                ('Most expensive headers', 'expensive_headers'),
+                ('Template instantiation hot spots', 'instantiations')]:
+            if not project[key]:
+                continue
+            #endif
+
+            Logs.pprint('CYAN', '  %s:' % title)
+            for entry, duration in project[key]:
+                Logs.pprint('NORMAL', '    %8.3fs %s' % (duration, entry))
+            #endfor
+        #endfor
+    #endfor
+
+    report = {'time': time.time(), 'projects': projects}
+
+    with open(os.path.join(trace_dir, 'report.json'), 'w', encoding='utf-8') as report_file:
+        report_file.write(json.dumps(report, indent=4, sort_keys=True))
+    #endwith
+
+    with open(history_file, 'a', encoding='utf-8') as history:
+        history.write(json.dumps(report, sort_keys=True) + '\n')
+    #endwith
+#enddef
+
+# Add -ftime-trace to the compile flags when --time-trace is passed
+def enable_time_trace(bld):
+    if not bld.options.time_trace:
+        return
+    #endif
+
+    if bld.env.CC_NAME != 'clang' and bld.env.CXX_NAME != 'clang':
+        Logs.warn('--time-trace is only supported by clang toolsets, ignoring it.')
+        return
+    #endif
+
+    for env_flag, name in [('CFLAGS', bld.env.CC_NAME), ('CXXFLAGS', bld.env.CXX_NAME)]:
+        if name == 'clang':
+            bld.env.append_unique(env_flag, ['-ftime-trace'])
+        #endif
+    #endfor
+
+    bld.add_post_fun(report_time_trace)
+#enddef
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import copy, glob, hashlib, json, os, shutil, sys, tempfile
+
+from waflib import Utils
+
+from ArtifactCache import get_toolset_fingerprint, make_relocatable
+from Common import get_use
+
+# Default location of the store shared between build directories and branches
+DEFAULT_VENDOR_STORE = os.path.join('~', '.cache', 'lotuswaf', 'vendored')
+
+# Hash the relative paths and contents of all files in a vendored source tree
+def hash_source_tree(hasher, path):
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != 'build')
+
+        for name in sorted(files):
+            file = os.path.join(root, name)
+            hasher.update(os.path.relpath(file, path).replace('\\', '/').encode('utf-8'))
+
+            with open(file, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+                #endfor
+            #endwith
+        #endfor
+    #endfor
+#enddef
+
+# Options of a use flag that contain paths relative to the top directory
+USE_FLAG_PATHS = ['includes', 'shlib_path', 'stlib_path']
+
+# The use flags a vendored project uses, directly or through other use flags
+def get_project_use(cfg, use_flag, common, source):
+    if not 'project' in common:
+        return dict()
+    #endif
+
+    file = os.path.join(source, common['project'] + '.lotus_project')
+    with open(file, encoding='utf-8') as project_file:
+        project = json.loads(project_file.read())
+    #endwith
+
+    use = get_use(cfg)
+    project_use = dict()
+
+    todo = list(project.get('use', []))
+    while todo:
+        name = todo.pop()
+        if name in project_use:
+            continue
+        #endif
+
+        if not name in use:
+            cfg.fatal(use_flag + ': The vendored project uses ' + name \
+                + ', which is not a use flag!')
+        #endif
+
+        if use[name]['type'] == 'vendored':
+            cfg.fatal(use_flag + ': The vendored project uses ' + name \
+                + ', vendored projects cannot use other vendored use flags!')
+        #endif
+
+        project_use[name] = use[name]
+        for block in use[name].values():
+            if isinstance(block, dict):
+                todo += block.get('use', [])
+            #endif
+        #endfor
+    #endfor
+
+    return project_use
+#enddef
+
+# The configure options of this workspace that apply to a vendored project,
+# passed on to the nested configure so it builds with the same flags
+def get_forwarded_options(cfg, project_use):
+    options = cfg.options.__dict__
+    top = cfg.path.abspath()
+
+    forwarded = [
+        '--toolset=' + cfg.env.cur_toolset,
+        '--target-configuration=' + cfg.env.cur_conf,
+        '--target-platform=' + cfg.env.cur_platform
+    ]
+
+    if not options['development']:
+        forwarded.append('--release')
+    #endif
+
+    if options['reproducible']:
+        forwarded.append('--reproducible')
+    #endif
+
+    for use_flag in sorted(project_use):
+        if options.get('without_' + use_flag):
+            forwarded.append('--without-' + use_flag)
+        #endif
+
+        if options.get('with_' + use_flag):
+            forwarded.append('--with-%s=%s' % (use_flag, options['with_' + use_flag]))
+        #endif
+
+        for option in ['includes', 'libpath', 'stlibpath']:
+            for path in options.get(use_flag + '_' + option) or []:
+                forwarded.append('--%s-%s=%s' % (use_flag, option, os.path.join(top, path)))
+            #endfor
+        #endfor
+
+        for option in ['lib', 'stlib']:
+            if options.get(use_flag + '_' + option):
+                forwarded.append('--%s-%s=%s' % (use_flag, option, options[use_flag + '_' + option]))
+            #endif
+        #endfor
+    #endfor
+
+    return forwarded
+#enddef
+
+# The key changes when the sources, the use flag, the use flags of a vendored
+# project, the configure options, or the toolset change. The paths of this
+# checkout are left out, so every checkout shares the store.
+def get_vendor_key(cfg, use_flag, definition, source, project_use, forwarded):
+    hasher = hashlib.md5()
+    hasher.update(json.dumps(definition, sort_keys=True).encode('utf-8'))
+    hasher.update(json.dumps(project_use, sort_keys=True).encode('utf-8'))
+
+    for option in forwarded:
+        hasher.update(make_relocatable(option, cfg.path.abspath()).encode('utf-8'))
+    #endfor
+
+    for value in [
+            use_flag,
+            cfg.env.cur_toolset,
+            cfg.env.cur_conf,
+            cfg.env.cur_platform,
+            get_toolset_fingerprint(cfg, relocatable=True)]:
+        hasher.update(str(value).encode('utf-8'))
+    #endfor
+
+    hash_source_tree(hasher, source)
+    return hasher.hexdigest()
+#enddef
+
+def get_recipe_env(cfg, source, build_dir, prefix):
+    env = dict(os.environ)
+
+    env.update({
+        'SOURCE': source,
+        'BUILD': build_dir,
+        'PREFIX': prefix,
+        'CC': ' '.join(Utils.to_list(cfg.env.CC)),
+        'CXX': ' '.join(Utils.to_list(cfg.env.CXX)),
+        'AR': ' '.join(Utils.to_list(cfg.env.AR)),
+        'CFLAGS': ' '.join(cfg.env.CFLAGS),
+        'CXXFLAGS': ' '.join(cfg.env.CXXFLAGS),
+        'LDFLAGS': ' '.join(cfg.env.LDFLAGS),
+        'TOOLSET': cfg.env.cur_toolset,
+        'CONFIGURATION': cfg.env.cur_conf,
+        'PLATFORM': cfg.env.cur_platform,
+        'WAF': '"%s" "%s"' % (sys.executable, os.path.abspath(sys.argv[0]))
+    })
+
+    return env
+#enddef
+
+# The workspace in which a vendored .lotus_project is built, it loads this
+# LotusWaf and builds the project in the copy of the vendored sources
+VENDOR_WSCRIPT = '''#!/usr/bin/env python3
+# encoding: utf-8
+
+top = '.'
+out = 'build'
+
+def options(opt):
+	opt.load('LotusWaf', tooldir=%(tooldir)r)
+
+def configure(cfg):
+	cfg.load('LotusWaf', tooldir=%(tooldir)r)
+
+def build(bld):
+	bld.recurse('source', name='vendored')
+'''
+
+# Create the workspace of a vendored project in build_dir. It has the project
+# configurations and toolsets of this workspace, the use flags the project uses
+# and a copy of the vendored sources, so nothing is written into them. The paths
+# of the use flags are made absolute, they are relative to this workspace.
+def create_vendor_workspace(cfg, project, source, build_dir, project_use):
+    top = cfg.path.abspath()
+
+    shutil.copy2(os.path.join(top, 'project_configurations.lotus_config'), build_dir)
+    shutil.copytree(os.path.join(top, 'Toolsets'), os.path.join(build_dir, 'Toolsets'))
+    shutil.copytree(os.path.join(top, 'UseFlags'), os.path.join(build_dir, 'UseFlags'))
+
+    use = copy.deepcopy(project_use)
+    for definition in use.values():
+        for block in definition.values():
+            if not isinstance(block, dict):
+                continue
+            #endif
+
+            for option in USE_FLAG_PATHS:
+                if option in block:
+                    block[option] = [os.path.join(top, path) for path in block[option]]
+                #endif
+            #endfor
+        #endfor
+    #endfor
+
+    with open(os.path.join(build_dir, 'UseFlags', 'use_flags.lotus_use'), 'w', encoding='utf-8') as use_file:
+        use_file.write(json.dumps(use, indent=4))
+    #endwith
+
+    shutil.copytree(
+        source,
+        os.path.join(build_dir, 'source'),
+        ignore=shutil.ignore_patterns('.*', 'build'))
+
+    with open(os.path.join(build_dir, 'source', 'wscript_vendored'), 'w', encoding='utf-8') as build_file:
+        build_file.write('bld.project(%r)\n' % project)
+    #endwith
+
+    with open(os.path.join(build_dir, 'wscript'), 'w', encoding='utf-8') as wscript:
+        wscript.write(VENDOR_WSCRIPT % {'tooldir': os.path.dirname(os.path.abspath(__file__))})
+    #endwith
+#enddef
+
+# A vendored .lotus_project is built with a nested waf in a generated workspace,
+# after which its artifacts are copied into the prefix. The artifact patterns
+# are matched in the vendored sources and in the output directory of the project.
+def build_project(cfg, common, source, build_dir, prefix, env, project_use, forwarded):
+    create_vendor_workspace(cfg, common['project'], source, build_dir, project_use)
+
+    # The workspace is thrown away, waf shouldn't leave a lock file next to it
+    env = dict(env)
+    env['NO_LOCK_IN_TOP'] = '1'
+
+    command = [
+        sys.executable,
+        os.path.abspath(sys.argv[0]),
+        'configure',
+        'build'
+    ] + forwarded
+
+    if cfg.exec_command(command, cwd=build_dir, env=env) != 0:
+        return False
+    #endif
+
+    roots = [source, os.path.join(build_dir, 'build', 'source')]
+
+    artifacts = common.get('artifacts', {})
+    for directory in artifacts:
+        os.makedirs(os.path.join(prefix, directory), exist_ok=True)
+
+        for pattern in artifacts[directory]:
+            for root in roots:
+                for path in glob.glob(os.path.join(root, pattern)):
+                    target = os.path.join(prefix, directory, os.path.basename(path))
+
+                    if os.path.isdir(path):
+                        shutil.copytree(path, target, dirs_exist_ok=True)
+                    else:
+                        shutil.copy2(path, target)
+                    #endif
+                #endfor
+            #endfor
+        #endfor
+    #endfor
+
+    return True
+#enddef
+
+# Build a use flag of type "vendored" into the store, unless it is already there.
+# Returns the prefix that contains the built libraries and headers.
+def build_vendored(cfg, use_flag, definition):
+    common = definition['common']
+    if not 'source' in common:
+        cfg.fatal(use_flag + ': A "source" directive is required for vendored use flags!')
+    #endif
+
+    if not 'recipe' in common and not 'project' in common:
+        cfg.fatal(use_flag + ': A "recipe" or "project" directive is required for ' \
+            + 'vendored use flags!')
+    #endif
+
+    source = os.path.normpath(os.path.join(cfg.path.abspath(), common['source']))
+    if not os.path.isdir(source):
+        cfg.fatal(use_flag + ': Vendored source directory ' + source + ' does not exist!')
+    #endif
+
+    store = os.path.expanduser(cfg.options.vendor_store)
+    project_use = get_project_use(cfg, use_flag, common, source)
+    forwarded = get_forwarded_options(cfg, project_use)
+    key = get_vendor_key(cfg, use_flag, definition, source, project_use, forwarded)
+    prefix = os.path.join(store, use_flag + '-' + key)
+
+    if os.path.isdir(prefix):
+        cfg.msg('Building vendored <' + use_flag + '>', 'cached')
+        return prefix
+    #endif
+
+    cfg.start_msg('Building vendored <' + use_flag + '>')
+    os.makedirs(store, exist_ok=True)
+
+    # Build into a temporary prefix, so other builds never see a partial build
+    tmp_prefix = tempfile.mkdtemp(dir=store, prefix='.tmp-' + use_flag + '-')
+    build_dir = tempfile.mkdtemp(prefix='lotus-' + use_flag + '-')
+    env = get_recipe_env(cfg, source, build_dir, tmp_prefix)
+
+    try:
+        success = True
+        if 'project' in common:
+            success = build_project(
+                cfg, common, source, build_dir, tmp_prefix, env, project_use, forwarded)
+        else:
+            for command in common['recipe']:
+                if cfg.exec_command(command, cwd=build_dir, env=env, shell=True) != 0:
+                    success = False
+                    break
+                #endif
+            #endfor
+        #endif
+
+        if not success:
+            cfg.end_msg('failed', color='RED')
+            cfg.fatal(use_flag + ': Building the vendored sources failed, see config.log.')
+        #endif
+
+        try:
+            os.rename(tmp_prefix, prefix)
+        except OSError:
+            # Another configure built the same key at the same time
+            if not os.path.isdir(prefix):
+                raise
+            #endif
+        #endtry
+    finally:
+        shutil.rmtree(tmp_prefix, ignore_errors=True)
+        shutil.rmtree(build_dir, ignore_errors=True)
+    #endtry
+
+    cfg.end_msg(prefix)
+    return prefix
+#enddef
+
+# Turn a vendored use flag into a "lib" use flag, of which the include and
+# library paths are relative to the prefix the vendored sources were built in
+def resolve_vendored(cfg, use_flag, definition):
+    prefix = build_vendored(cfg, use_flag, definition)
+
+    definition = copy.deepcopy(definition)
+    definition['type'] = 'lib'
+
+    definition['common'].setdefault('includes', ['include'])
+    definition['common'].setdefault('shlib_path', ['lib'])
+    definition['common'].setdefault('stlib_path', ['lib'])
+
+    for block in definition.values():
+        if not isinstance(block, dict):
+            continue
+        #endif
+
+        for option in USE_FLAG_PATHS:
+            if option in block:
+                block[option] = [os.path.join(prefix, path) for path in block[option]]
+            #endif
+        #endfor
+    #endfor
+
+    return definition
+#enddef